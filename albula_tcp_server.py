@@ -4,34 +4,67 @@ Commands available:
 
 * frame [frame_number]
 * image frame_index [filename]
+* image_nowait frame_index filename : load the image in a worker thread and reply at once
+* image_wait frame_index [timeout] : wait for the image requested by image_nowait and reply as image does
 * test frame_index [test_index]
 * rect frame_index [left top width height]
 * limit frame_index [lower_count_limit upper_count_limit]
 * count frame_index
+* roi frame_index [name [left top width height | MASK npy_filename]]
+* counts frame_index : statistics of every named roi in one line
+* follow frame_index [directory [pattern] | OFF] : load each new file in the directory automatically
+* result frame_index : count and roi statistics of the last file loaded by follow
+* cache [max_megabytes prefetch_count]
+* reader [albula|native] : decode CBF files with ALBULA or with the native NumPy reader (bl_cbf.py)
+* display [ON [interval_ms] | OFF | NOW] : show images in the ALBULA window at most every interval_ms
+  (only on "display now" if negative), close the window (headless), or update it at once
+* stats [reset], protocol [text|binary] (implemented by the parent class)
 * quit
 
+The server requires Python 3 (and the ALBULA Python binding for the same version).
 The following code in Command Prompt launches the server 
 with its port 10001 and Pilatus server sharing point "W:/".
 
 ```
 @REM Uncomment below if Anaconda is installed in a user domain
-@REM call %HOMEPATH%\Anaconda3\Scripts\activate.bat py27
+@REM call %HOMEPATH%\Anaconda3\Scripts\activate.bat py3
 
 @REM Uncomment below if Anaconda is installed in the system domain
-@REM call %PROGRAMDATA%\Anaconda3\Scripts\activate.bat py27
+@REM call %PROGRAMDATA%\Anaconda3\Scripts\activate.bat py3
 
 python albula_tcp_server.py 10001 W:/
 ```
-"""
 
-from __future__ import division, print_function, unicode_literals
+Without ALBULA (or with "--native"), CBF files are decoded by the native
+reader, which only needs NumPy; images are then counted but not displayed.
+
+Images, ROIs and counts are kept independently of the ALBULA window, which
+mirrors the images from a background thread at a limited rate. "--headless"
+starts the server without the window.
+
+ALBULA is imported on first use, and the window is opened in the background,
+so that the server accepts clients at once. With "--state=FILE", the number
+of frames, image paths, rects, count limits and ROIs are saved to FILE (JSON,
+replaced atomically) whenever they change, and restored when the server starts;
+the images are then read in the worker threads, without waiting for missing
+files, or when they are first counted.
+"""
 
 import sys
 import os
 import re
+import json
 import socket
-from socketserver import TCPServer
-from bl_tcp_server import BLRequestHandler
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from socketserver import TCPServer, ThreadingMixIn
+from bl_tcp_server import BLRequestHandler, STATS, start_metrics_server
+from bl_roi import RoiSet, STAT_NAMES
+from bl_cbf import CbfImage, Rect
+from bl_watch import DirectoryWatcher
+from bl_async_server import AsyncBLServer
 
 albula_base_dir = ''
 if (os.name == 'nt'):
@@ -43,7 +76,29 @@ elif (os.name == 'posix'):
 sys.path.insert(0, os.path.join(albula_base_dir, 'bin'))
 sys.path.insert(0, os.path.join(albula_base_dir, 'python'))
 
-import dectris.albula
+import numpy
+
+_albula = None
+_albula_imported = False
+_albula_import_lock = threading.Lock()
+
+
+def albula_module():
+    """Import `dectris.albula` on first use, which takes a while.
+    Return the module, or None if ALBULA is not available (only the native CBF reader is).
+    """
+
+    global _albula, _albula_imported
+    if not _albula_imported:
+        with _albula_import_lock:
+            if not _albula_imported:
+                try:
+                    import dectris.albula
+                    _albula = dectris.albula
+                except ImportError:
+                    _albula = None
+                _albula_imported = True
+    return _albula
 
 
 # constants
@@ -51,26 +106,346 @@ import dectris.albula
 ACTIVE_COLOR = (0, 128, 0)
 NON_ACTIVE_COLOR = (0, 64, 0)
 
+# interval in seconds to check for a file that does not exist yet (native reader).
+FILE_POLL_INTERVAL = 0.05
+
+# minimum interval in seconds between updates of the ALBULA window.
+DISPLAY_INTERVAL = 0.2
+
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+PREFETCH_COUNT = 4
+
+# threads decoding images requested by image_nowait
+# (and, in the asyncio server, processing commands).
+ALBULA_WORKERS = 4
+
 
 #  class definision
 
-class AlbulaTCPServer(TCPServer, object):
-    """Albula TCP server class.
+def image_nbytes(image):
+    """Estimate the memory used by an image.
+
+    The array of a natively decoded image is at hand; `data()` of an ALBULA image
+    would copy the whole image, so 4 bytes per pixel are assumed instead.
     """
+    if isinstance(image, CbfImage):
+        return image.array.nbytes
+    return image.width() * image.height() * 4
 
-    def __init__(self, server_address, requestHandlerClass, bind_and_activate=True, base_dir = './', det_num = 0):
-        super(AlbulaTCPServer, self).__init__(server_address, requestHandlerClass, bind_and_activate)
 
-        self.main_frame = dectris.albula.openMainFrame(disableClose = True)
+class ImageCache(object):
+    """Size-bounded LRU cache of decoded images keyed on path and modification time.
+
+    The least recently used images are evicted when the total size exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(path):
+        """Return the cache key of a file, or None if the file does not exist (yet)."""
+        try:
+            return (os.path.abspath(path), os.path.getmtime(path))
+        except OSError:
+            return None
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = self.entries.pop(key)
+            self.hits += 1
+            return entry[0]
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, image):
+        nbytes = image_nbytes(image)
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self.entries[key] = (image, nbytes)
+            self.total_bytes += nbytes
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            _, (_, nbytes) = self.entries.popitem(last=False)
+            self.total_bytes -= nbytes
+
+
+class ImagePrefetcher(object):
+    """Decode the next files of a numbered series (e.g., in16c_010001.cbf, in16c_010002.cbf, ...)
+    in a background thread and store them in an `ImageCache`.
+
+    Only files that already exist are prefetched, since readImage may otherwise wait for them.
+    """
+
+    series_pattern = re.compile(r'^(.*?)([0-9]+)(\.[^.\\/]*)?$')
+
+    def __init__(self, cache, read_image, count=PREFETCH_COUNT):
+        self.cache = cache
+        self.read_image = read_image
+        self.count = count
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.thread = None
+
+    def next_paths(self, path):
+        """Return the paths of up to `count` files following `path` in its series."""
+
+        matched = self.series_pattern.match(path)
+        if not matched:
+            return []
+        prefix, number, suffix = matched.group(1), matched.group(2), matched.group(3) or ''
+        return ['{}{:0>{}}{}'.format(prefix, int(number) + i, len(number), suffix) for i in range(1, self.count + 1)]
+
+    def schedule(self, path):
+        paths = self.next_paths(path)
+        if not paths:
+            return
+
+        with self.condition:
+            # paths of an older position in the series are no longer interesting.
+            self.queue.clear()
+            self.queue.extend(paths)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                path = self.queue.popleft()
+
+            key = ImageCache.key(path)
+            if key is None or key in self.cache:
+                continue
+            try:
+                with STATS.device_call('readImage_prefetch'):
+                    image = self.read_image(path, False)
+                if image is not None:
+                    self.cache.put(key, image)
+            except Exception:
+                # leave the file to the foreground load, which reports errors.
+                pass
+
+class DisplayMirror(object):
+    """Shows the images of updated subframes in a background thread.
+
+    Updates are coalesced: the subframes marked since the last update are shown
+    together, at most once per `interval` seconds (never automatically if
+    `interval` is negative), so that loading images does not wait for the display.
+    """
+
+    def __init__(self, show, interval=DISPLAY_INTERVAL):
+        self.show = show
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.dirty = set()
+        self.last_update = 0.0
+        self.updates = 0
+        self.stopped = False
+        self.thread = None
+
+    def mark(self, frame_index):
+        with self.condition:
+            self.dirty.add(frame_index)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def set_interval(self, interval):
+        with self.condition:
+            self.interval = interval
+            self.condition.notify()
+
+    def flush(self, frame_indices=()):
+        """Show the marked subframes and `frame_indices` in the calling thread."""
+
+        with self.condition:
+            frame_indices = sorted(self.dirty.union(frame_indices))
+            self.dirty.clear()
+            self.last_update = time.time()
+        self._show(frame_indices)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.dirty or self.interval < 0):
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                delay = self.last_update + self.interval - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                frame_indices = sorted(self.dirty)
+                self.dirty.clear()
+                self.last_update = time.time()
+            self._show(frame_indices)
+
+    def _show(self, frame_indices):
+        for frame_index in frame_indices:
+            try:
+                self.show(frame_index)
+            except Exception as e:
+                print('Failed to display frame {}: {}'.format(frame_index, e))
+        self.updates += 1
+
+
+class StateFile(object):
+    """Keeps a snapshot of the server configuration in a JSON file.
+
+    `mark` requests a new snapshot, which a background thread takes by calling
+    `snapshot` and writes to a temporary file that then replaces the old one,
+    so that a crash never leaves a partial file. Marks made while a snapshot
+    is written are coalesced into one more.
+    """
+
+    def __init__(self, path, snapshot):
+        self.path = path
+        self.snapshot = snapshot
+        self.condition = threading.Condition()
+        self.dirty = False
+        self.stopped = False
+        self.saves = 0
+        self.thread = None
+
+    def load(self):
+        """Return the saved state, or None if there is none or it cannot be read."""
+
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            if os.path.exists(self.path):
+                print('Failed to read the state file {}: {}'.format(self.path, e))
+            return None
+
+    def mark(self):
+        with self.condition:
+            self.dirty = True
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def close(self):
+        """Write a pending snapshot and stop the thread."""
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.dirty and not self.stopped:
+                    self.condition.wait()
+                if not self.dirty:
+                    return
+                self.dirty = False
+            try:
+                self.write(self.snapshot())
+            except Exception as e:
+                print('Failed to write the state file {}: {}'.format(self.path, e))
+
+    def write(self, state):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        getattr(os, 'replace', os.rename)(temp_path, self.path)
+        self.saves += 1
+
+
+class AlbulaServerMixIn(object):
+    """Albula state and operations shared by the TCP server classes.
+
+    Mixed into a server class, the same way as `socketserver.ThreadingMixIn`.
+    """
+
+    def init_albula(self, base_dir = './', det_num = 0, native_reader = False, headless = False, state_file = None):
+        self.main_frame = None
+        # ALBULA is used if it turns out to be available when the first image is read.
+        self.native_reader = native_reader
         self.base_dir = base_dir
         self.sub_frames = []
         self.images = []
         self.image_paths = []
         self.rects = []
         self.count_limits = []
+        self.roi_sets = []
+        # mask file of each mask ROI, for the state file.
+        self.roi_mask_paths = []
+        self.followers = {}
+        self.follow_results = []
+        # guards the number of subframes; `frame_locks[i]` serializes the operations on subframe i,
+        # so that independent subframes are loaded and counted in parallel.
+        self.albula_lock = threading.RLock()
+        self.frame_locks = []
+        # ALBULA GUI objects are touched by one thread at a time.
+        self.display_lock = threading.Lock()
+        self.pending_images = {}
+        self.albula_pool = ThreadPoolExecutor(max_workers=ALBULA_WORKERS)
+        self.image_cache = ImageCache()
+        self.prefetcher = ImagePrefetcher(self.image_cache, self.read_albula_image)
+        self.display_mirror = DisplayMirror(self.display_albula_image)
+
+        if not headless:
+            # importing ALBULA and opening the window take a while; clients are served meanwhile.
+            thread = threading.Thread(target=self.open_albula_display)
+            thread.daemon = True
+            thread.start()
+
+        self.state_file = StateFile(state_file, self.get_albula_state) if state_file is not None else None
+        self.restoring = False
+        state = self.state_file.load() if self.state_file is not None else None
+        self.state_restored = state is not None
+        if state is not None:
+            self.restore_albula_state(state)
+        else:
+            self.set_albula_frame_number(det_num)
 
-        self.set_albula_frame_number(det_num)
-        
     # def show_subframes(self):
     #     shown_sub_frames = self.main_frame.subFrames()
     #     for i in range(len(self.sub_frames)):
@@ -81,38 +456,189 @@ class AlbulaTCPServer(TCPServer, object):
     #             sub_frame.setNonActiveColor(*NON_ACTIVE_COLOR)
     #             self.sub_frames[i] = sub_frame
 
-    def server_close(self):
-        super(AlbulaTCPServer, self).server_close()
-        self.close_albula()
-
     def close_albula(self):
-        if self.main_frame is not None:
-            self.main_frame.close()
-            self.main_frame = None
+        self.stop_albula_follow()
+        self.albula_pool.shutdown(wait=False)
+        self.close_albula_display()
+        self.display_mirror.stop()
+        if self.state_file is not None:
+            self.state_file.close()
+
+    def mark_albula_state(self):
+        """Save the configuration to the state file (in the background) after a change."""
+
+        # the state being restored is the one in the file.
+        if self.state_file is not None and not self.restoring:
+            self.state_file.mark()
+
+    def get_albula_state(self):
+        """Return the configuration to be restored by `restore_albula_state`, a JSON-compatible dict."""
+
+        with self.albula_lock:
+            frames = []
+            for frame_index in range(len(self.images)):
+                rect = self.rects[frame_index]
+                roi_set = self.roi_sets[frame_index]
+                rois = [[name, list(rect)] for name, rect in list(roi_set.rects.items())]
+                rois += [[name, 'MASK', path] for name, path in list(self.roi_mask_paths[frame_index].items())]
+                frames.append({
+                    'image_path': self.image_paths[frame_index],
+                    'rect': [rect.left(), rect.top(), rect.width(), rect.height()] if rect is not None else None,
+                    'count_limits': self.count_limits[frame_index],
+                    'rois': rois,
+                })
+            return {'frames': frames}
+
+    def restore_albula_state(self, state):
+        """Restore a configuration saved by `get_albula_state`.
+
+        The image paths are restored as they are; the images are read in the worker
+        threads without waiting for missing files, or when they are first counted.
+        """
+
+        frames = state.get('frames', [])
+        self.restoring = True
+        try:
+            self.set_albula_frame_number(len(frames))
+            for frame_index, frame in enumerate(frames):
+                if frame.get('rect') is not None:
+                    self.set_albula_rect(frame_index, *frame['rect'])
+                if frame.get('count_limits'):
+                    limits = frame['count_limits']
+                    self.set_albula_count_limit(frame_index, limits['lowerCountLimit'], limits['upperCountLimit'])
+                for roi in frame.get('rois', []):
+                    if len(roi) == 3:
+                        self.set_albula_roi(frame_index, roi[0], mask_path=roi[2])
+                    else:
+                        self.set_albula_roi(frame_index, roi[0], *roi[1])
+                self.image_paths[frame_index] = frame.get('image_path')
+        finally:
+            self.restoring = False
+
+        for frame_index, image_path in enumerate(self.image_paths):
+            if image_path is not None:
+                self.albula_pool.submit(self._load_restored_image, frame_index, image_path)
+
+    def _load_restored_image(self, frame_index, image_path):
+        with self.albula_frame_lock(frame_index):
+            # the frame may have been given another image meanwhile.
+            if frame_index < len(self.images) and self.image_paths[frame_index] == image_path:
+                self.get_albula_image(frame_index)
+
+    def get_albula_image(self, frame_index):
+        """Return the image of a frame, reading a restored image that has not been read yet
+        (without waiting for the file). Return None if the frame has no image."""
+
+        image = self.images[frame_index]
+        if image is None and self.image_paths[frame_index] is not None:
+            image = self.load_albula_image(os.path.join(self.base_dir, self.image_paths[frame_index]), wait=False)
+            if image is not None:
+                self.images[frame_index] = image
+                if self.main_frame is not None:
+                    self.display_mirror.mark(frame_index)
+        return image
+
+    def open_albula_display(self):
+        """Open the ALBULA window with a subframe per frame and show the current images."""
+
+        albula = albula_module()
+        if albula is None:
+            return 1
+        with self.display_lock:
+            if self.main_frame is None:
+                self.main_frame = albula.openMainFrame(disableClose = True)
+                self.sub_frames = [self._open_sub_frame() for _ in self.images]
+        for frame_index, image in enumerate(self.images):
+            if image is not None:
+                self.display_mirror.mark(frame_index)
+        return 0
+
+    def close_albula_display(self):
+        """Close the ALBULA window. Images, ROIs and counts are kept."""
+
+        with self.display_lock:
+            if self.main_frame is not None:
+                for sub_frame in self.sub_frames:
+                    if sub_frame is not None:
+                        sub_frame.close()
+                self.main_frame.close()
+                self.main_frame = None
+                self.sub_frames = [None] * len(self.images)
+        return 0
+
+    def set_albula_display_interval(self, interval):
+        self.display_mirror.set_interval(interval)
+        return 0
+
+    def get_albula_display(self):
+        return {'on': self.main_frame is not None, 'interval': self.display_mirror.interval,
+                'updates': self.display_mirror.updates}
+
+    def refresh_albula_display(self):
+        """Show the current images at once."""
+
+        if self.main_frame is None:
+            return 1
+        self.display_mirror.flush(range(len(self.images)))
+        return 0
+
+    def _open_sub_frame(self):
+        sub_frame = self.main_frame.openSubFrame()
+        sub_frame.setActiveColor(*ACTIVE_COLOR)
+        sub_frame.setNonActiveColor(*NON_ACTIVE_COLOR)
+        return sub_frame
+
+    def albula_frame_lock(self, frame_index):
+        """Return the lock of a subframe. Locks are kept when the number of subframes changes."""
+
+        with self.albula_lock:
+            while len(self.frame_locks) <= frame_index:
+                self.frame_locks.append(threading.RLock())
+            return self.frame_locks[frame_index]
 
     def set_albula_frame_number(self, det_num):
+        with self.albula_lock:
+            # wait until no operation on any old or new subframe is in progress.
+            locks = [self.albula_frame_lock(i) for i in range(max(len(self.images), det_num))]
+            for lock in locks:
+                lock.acquire()
+            try:
+                with self.display_lock:
+                    self._set_albula_frame_number(det_num)
+            finally:
+                for lock in locks:
+                    lock.release()
+
+    def _set_albula_frame_number(self, det_num):
+        self.stop_albula_follow()
+
         # close all preexisting subframes
         for sub_frame in self.sub_frames:
-            sub_frame.close()
+            if sub_frame is not None:
+                sub_frame.close()
         self.sub_frames = []
         self.images = []
         self.image_paths = []
         self.rects = []
         self.count_limits = []
+        self.roi_sets = []
+        self.roi_mask_paths = []
+        self.follow_results = []
 
         # create new subframes and register them
         for _ in range(det_num):
-            sub_frame = self.main_frame.openSubFrame()
-            sub_frame.setActiveColor(*ACTIVE_COLOR)
-            sub_frame.setNonActiveColor(*NON_ACTIVE_COLOR)
-            self.sub_frames.append(sub_frame)
+            self.sub_frames.append(self._open_sub_frame() if self.main_frame is not None else None)
             self.images.append(None)
             self.image_paths.append(None)
             self.rects.append(None)
             self.count_limits.append({})
+            self.roi_sets.append(RoiSet())
+            self.roi_mask_paths.append(OrderedDict())
+            self.follow_results.append(None)
+        self.mark_albula_state()
 
     def get_albula_frame_number(self):
-        return len(self.sub_frames)
+        return len(self.images)
 
         # dectris_image = dectris.albula.readImage(r"C:\Program Files (x86)\DECTRIS\ALBULA\ALBULA_3.3.0\testData\in16c_010001.cbf")
         # main_frame, sub_frame = dectris.albula.display(dectris_image)
@@ -123,30 +649,164 @@ class AlbulaTCPServer(TCPServer, object):
 
     def set_albula_image_file(self, frame_index, image_path):
         # check if the frame exists
-        if frame_index >= len(self.sub_frames):
+        if frame_index >= len(self.images):
             return 1
 
-        try:
-            image = dectris.albula.readImage(os.path.join(self.base_dir, image_path), -1) # timeout < 0: wait forever
-        except dectris.albula.DNoFileAccessException:
+        full_path = os.path.join(self.base_dir, image_path)
+        image = self.load_albula_image(full_path)
+        if image is None:
             return 2
-        # self.sub_frames[frame_index].loadImage(image)
-
-        try:
-            self.sub_frames[frame_index].loadImage(image)
-            # self.sub_frames[frame_index].loadFile(image_path)
-        except dectris.albula.DNoObject:
-            sub_frame = self.main_frame.openSubFrame()
-            sub_frame.setActiveColor(*ACTIVE_COLOR)
-            sub_frame.setNonActiveColor(*NON_ACTIVE_COLOR)
-            sub_frame.loadImage(image)
-            # sub_frame.loadFile(image_path)
-            self.sub_frames[frame_index] = sub_frame
 
         self.images[frame_index] = image
         self.image_paths[frame_index] = image_path
+        if self.main_frame is not None:
+            self.display_mirror.mark(frame_index)
+        self.mark_albula_state()
+        return 0
+
+    def display_albula_image(self, frame_index):
+        """Show the current image of a frame in its subframe. Called by `display_mirror`."""
+
+        with self.display_lock:
+            if self.main_frame is None or frame_index >= len(self.images):
+                return
+            image = self.images[frame_index]
+            if image is None:
+                return
+            albula = albula_module()
+            if isinstance(image, CbfImage):
+                # decoded by the native reader; ALBULA needs its own image to display.
+                try:
+                    with STATS.device_call('readImage_display'):
+                        image = albula.readImage(os.path.join(self.base_dir, self.image_paths[frame_index]))
+                except albula.DNoFileAccessException:
+                    return
+
+            with STATS.device_call('loadImage'):
+                try:
+                    self.sub_frames[frame_index].loadImage(image)
+                    # self.sub_frames[frame_index].loadFile(image_path)
+                except albula.DNoObject:
+                    sub_frame = self._open_sub_frame()
+                    sub_frame.loadImage(image)
+                    # sub_frame.loadFile(image_path)
+                    self.sub_frames[frame_index] = sub_frame
+
+    def submit_albula_image_file(self, frame_index, image_path):
+        """Load an image into a subframe in a worker thread. Return a future of the error code.
+
+        Loads submitted for the same subframe are applied in order.
+        """
+
+        with self.albula_lock:
+            previous = self.pending_images.get(frame_index)
+            future = self.albula_pool.submit(self._load_submitted_image, frame_index, image_path, previous)
+            self.pending_images[frame_index] = (image_path, future)
+        return future
+
+    def _load_submitted_image(self, frame_index, image_path, previous):
+        if previous is not None:
+            # the previous load was submitted earlier, and so, it has already been started.
+            previous[1].exception()
+        with self.albula_frame_lock(frame_index):
+            try:
+                return self.set_albula_image_file(frame_index, image_path)
+            except Exception as e:
+                # reported as an error code, so that waiting for the load does not raise.
+                print('Loading {} into subframe {} failed: {}'.format(image_path, frame_index, e))
+                return -1
+
+    def is_albula_image_pending(self, frame_index):
+        """Return True if a load submitted for a subframe has not finished yet."""
+
+        with self.albula_lock:
+            pending = self.pending_images.get(frame_index)
+        return pending is not None and not pending[1].done()
+
+    def wait_albula_image_file(self, frame_index, timeout=None, consume=True):
+        """Wait for the last load submitted for a subframe and return (image_path, errno),
+        or None if none has been submitted. Raise concurrent.futures.TimeoutError on timeout.
+
+        If `consume` is true, the finished load is forgotten, so that its result is returned once.
+        """
+
+        with self.albula_lock:
+            pending = self.pending_images.get(frame_index)
+        if pending is None:
+            return None
+        errno = pending[1].result(timeout)
+        if consume:
+            with self.albula_lock:
+                if self.pending_images.get(frame_index) is pending:
+                    del self.pending_images[frame_index]
+        return pending[0], errno
+
+    def load_albula_image(self, full_path, wait=True):
+        """Return the image at `full_path` from the cache or from the file.
+        Return None if the file is not accessible (or does not exist yet and `wait` is false).
+        """
+
+        key = ImageCache.key(full_path)
+        image = self.image_cache.get(key) if key is not None else None
+        if image is None:
+            with STATS.device_call('readImage'):
+                image = self.read_albula_image(full_path, wait)
+            if image is None:
+                return None
+            # the file may have been created while waiting.
+            key = ImageCache.key(full_path)
+            if key is not None:
+                self.image_cache.put(key, image)
+
+        self.prefetcher.schedule(full_path)
+        return image
+
+    def read_albula_image(self, full_path, wait=True):
+        """Decode an image file. Return None if the file is not accessible.
+
+        CBF files are decoded by the native reader if it is selected or ALBULA is unavailable;
+        other formats need ALBULA. If `wait` is true, a file that does not exist yet is waited for.
+        """
+
+        is_cbf = full_path.lower().endswith('.cbf')
+        albula = None if self.native_reader and is_cbf else albula_module()
+        if albula is None and not is_cbf:
+            return None
+        if albula is None:
+            while wait and not os.path.exists(full_path):
+                time.sleep(FILE_POLL_INTERVAL)
+            try:
+                return CbfImage.read(full_path)
+            except (IOError, OSError, ValueError, KeyError):
+                return None
+
+        try:
+            return albula.readImage(full_path, -1 if wait else 0) # timeout < 0: wait forever
+        except albula.DNoFileAccessException:
+            return None
+
+    def set_albula_reader(self, native_reader):
+        if not native_reader and albula_module() is None:
+            return 1
+        if native_reader != self.native_reader:
+            # do not mix images of the two readers.
+            self.image_cache.clear()
+            self.native_reader = native_reader
+        return 0
+
+    def get_albula_reader(self):
+        return self.native_reader or albula_module() is None
+
+    def set_albula_cache(self, max_bytes, prefetch_count):
+        self.image_cache.resize(max_bytes)
+        self.prefetcher.count = prefetch_count
         return 0
 
+    def get_albula_cache(self):
+        cache = self.image_cache
+        return {'max_bytes': cache.max_bytes, 'prefetch_count': self.prefetcher.count, 'entries': len(cache.entries),
+                'bytes': cache.total_bytes, 'hits': cache.hits, 'misses': cache.misses}
+
     def get_albula_image_file(self, frame_index = -1):
         if frame_index < 0:
             return self.image_paths
@@ -157,7 +817,10 @@ class AlbulaTCPServer(TCPServer, object):
         if left == -1 and top == -1 and width == -1 and height == -1:
             self.rects[frame_index] = None
         else:
-            self.rects[frame_index] = dectris.albula.DRect(left, top, width, height)
+            albula = albula_module()
+            rect_class = Rect if albula is None else albula.DRect
+            self.rects[frame_index] = rect_class(left, top, width, height)
+        self.mark_albula_state()
         return 0
 
     def get_albula_rect(self, frame_index = -1):
@@ -172,6 +835,7 @@ class AlbulaTCPServer(TCPServer, object):
 
     def set_albula_count_limit(self, frame_index, lower_count_limit, upper_count_limit):
         self.count_limits[frame_index] = { 'lowerCountLimit': lower_count_limit, 'upperCountLimit': upper_count_limit }
+        self.mark_albula_state()
         return 0
 
     def get_albula_count_limit(self, frame_index = -1):
@@ -181,29 +845,191 @@ class AlbulaTCPServer(TCPServer, object):
             return self.count_limits[frame_index]
 
     def get_albula_count(self, frame_index):
-        image = self.images[frame_index]
+        image = self.get_albula_image(frame_index)
+        if image is None:
+            return None
         rect = self.rects[frame_index]
         count_limits = self.count_limits[frame_index]
-        return image.mean(rect, **count_limits)
+        with STATS.device_call('mean'):
+            return image.mean(rect, **count_limits)
+
+    def set_albula_roi(self, frame_index, name, left=-1, top=-1, width=-1, height=-1, mask_path=None):
+        if frame_index >= len(self.roi_sets):
+            return 1
+
+        if mask_path is not None:
+            try:
+                mask = numpy.load(os.path.join(self.base_dir, mask_path))
+            except (IOError, OSError, ValueError):
+                return 2
+            self.roi_sets[frame_index].set_mask(name, mask)
+            self.roi_mask_paths[frame_index][name] = mask_path
+        elif left == -1 and top == -1 and width == -1 and height == -1:
+            self.roi_sets[frame_index].remove(name)
+            self.roi_mask_paths[frame_index].pop(name, None)
+        else:
+            self.roi_sets[frame_index].set_rect(name, left, top, width, height)
+            self.roi_mask_paths[frame_index].pop(name, None)
+        self.mark_albula_state()
+        return 0
+
+    def get_albula_roi(self, frame_index, name=None):
+        if name is None:
+            return self.roi_sets[frame_index].names()
+        else:
+            return self.roi_sets[frame_index].get(name)
+
+    def get_albula_counts(self, frame_index):
+        """Return a list of (name, stats) of all named ROIs in the current image of the frame."""
+
+        image = self.get_albula_image(frame_index)
+        if image is None:
+            return None
+        count_limits = self.count_limits[frame_index]
+        return self.roi_sets[frame_index].compute(
+            image.data(), count_limits.get('lowerCountLimit'), count_limits.get('upperCountLimit'))
+
+
+    def set_albula_follow(self, frame_index, directory, pattern='*'):
+        """Load every file completed in `directory` into the frame and compute its counts."""
+
+        if frame_index >= len(self.images):
+            return 1
+        directory = os.path.join(self.base_dir, directory)
+        if not os.path.isdir(directory):
+            return 2
+
+        self.stop_albula_follow(frame_index)
+        watcher = DirectoryWatcher(directory, None, pattern)
+        watcher.callback = lambda path: self.process_followed_file(watcher, frame_index, path)
+        watcher.start()
+        self.followers[frame_index] = watcher
+        return 0
+
+    def stop_albula_follow(self, frame_index = -1):
+        frame_indices = list(self.followers.keys()) if frame_index < 0 else [frame_index]
+        for index in frame_indices:
+            watcher = self.followers.pop(index, None)
+            if watcher is not None:
+                # do not wait for the thread, which may be waiting for albula_lock.
+                watcher.stop(wait=False)
+        return 0
+
+    def get_albula_follow(self, frame_index):
+        watcher = self.followers.get(frame_index)
+        if watcher is None:
+            return None
+        else:
+            return {'directory': watcher.directory, 'pattern': watcher.pattern, 'method': watcher.method}
+
+    def process_followed_file(self, watcher, frame_index, path):
+        """Called from a follower thread with a newly completed file."""
+
+        with self.albula_frame_lock(frame_index):
+            # the follower may have been stopped while waiting for the lock.
+            if self.followers.get(frame_index) is not watcher:
+                return
+            if self.set_albula_image_file(frame_index, path):
+                return
+            previous = self.follow_results[frame_index]
+            self.follow_results[frame_index] = {
+                'sequence': previous['sequence'] + 1 if previous else 1,
+                'path': path,
+                'count': self.get_albula_count(frame_index),
+                'counts': self.get_albula_counts(frame_index),
+            }
+
+    def get_albula_follow_result(self, frame_index):
+        return self.follow_results[frame_index]
+
+
+class AlbulaTCPServer(AlbulaServerMixIn, ThreadingMixIn, TCPServer, object):
+    """Albula TCP server class.
+
+    Each client is served by its own thread, so that a client waiting for an
+    image file does not block the others.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, requestHandlerClass, bind_and_activate=True, base_dir = './', det_num = 0,
+                 native_reader = False, headless = False, state_file = None):
+        super(AlbulaTCPServer, self).__init__(server_address, requestHandlerClass, bind_and_activate)
+        self.init_albula(base_dir, det_num, native_reader, headless, state_file)
+
+    def server_close(self):
+        super(AlbulaTCPServer, self).server_close()
+        self.close_albula()
+
+
+class AlbulaAsyncServer(AlbulaServerMixIn, AsyncBLServer):
+    """Albula server running on an asyncio event loop.
+
+    Commands on different subframes are processed in parallel by the worker threads.
+    """
+
+    def __init__(self, server_address, requestHandlerClass, bind_and_activate=True, base_dir = './', det_num = 0,
+                 native_reader = False, headless = False, state_file = None):
+        super(AlbulaAsyncServer, self).__init__(server_address, requestHandlerClass, bind_and_activate,
+                                                max_workers=ALBULA_WORKERS)
+        self.init_albula(base_dir, det_num, native_reader, headless, state_file)
+
+    def server_close(self):
+        super(AlbulaAsyncServer, self).server_close()
+        self.close_albula()
 
 
 class AlbulaRequestHandler(BLRequestHandler):
     """Concrete subclass of an abstract request handler.
     """
 
+    # commands whose first parameter is a subframe index.
+    frame_commands = ('TEST', 'IMAGE', 'RECT', 'LIMIT', 'COUNT', 'ROI', 'COUNTS', 'FOLLOW', 'RESULT')
+    # IMAGE waits for a file that has not been written yet.
+    blocking_commands = ('IMAGE', 'IMAGE_WAIT')
+
+    def is_blocking(self, line):
+        if BLRequestHandler.is_blocking(self, line):
+            return True
+        # a frame command first waits for an image being loaded into its subframe (IMAGE_NOWAIT).
+        words = line.split()
+        if len(words) > 1 and words[0].upper() in self.frame_commands:
+            try:
+                return self.server.is_albula_image_pending(int(words[1]))
+            except ValueError:
+                return False
+        return False
+
     def process_command(self, cmd, params):
         """Processing command received from client
         """
 
         cmd = cmd.upper()
+        if cmd in self.frame_commands and params and int(params[0]) >= 0:
+            frame_index = int(params[0])
+            # a lock is created per existing frame only.
+            if frame_index >= self.server.get_albula_frame_number():
+                self.send_response('ERROR:1', cmd.lower(), frame_index, 'no_frame')
+                return
+            # apply a pending image_nowait before the command.
+            self.server.wait_albula_image_file(frame_index, consume=False)
+            with self.server.albula_frame_lock(frame_index):
+                self.process_albula_command(cmd, params)
+        elif cmd in self.frame_commands or cmd in ('FRAME', 'READER', 'DISPLAY'):
+            with self.server.albula_lock:
+                self.process_albula_command(cmd, params)
+        else:
+            self.process_albula_command(cmd, params)
+
+    def process_albula_command(self, cmd, params):
         if cmd == 'FRAME':
             if len(params) == 1:
                 frame_number = int(params[0])
                 self.server.set_albula_frame_number(frame_number)
-                self.send_text_response('OK set_frame {}'.format(frame_number))
+                self.send_response('OK', 'set_frame', frame_number)
             elif len(params) == 0:
                 frame_number = self.server.get_albula_frame_number()
-                self.send_text_response('OK get_frame {}'.format(frame_number))
+                self.send_response('OK', 'get_frame', frame_number)
             else:
                 self.send_text_response('ERROR:102 frame illegal_arguments')
         elif cmd == 'TEST':
@@ -212,13 +1038,13 @@ class AlbulaRequestHandler(BLRequestHandler):
                 image_index = int(params[1])
                 errno = self.server.show_albula_test_image(frame_index, image_index)
                 if errno:
-                    self.send_text_response('ERROR:{} set_test {} {}'.format(errno, frame_index, image_index))
+                    self.send_response('ERROR:{}'.format(errno), 'set_test', frame_index, image_index)
                 else:
-                    self.send_text_response('OK set_test {} {}'.format(frame_index, image_index))
+                    self.send_response('OK', 'set_test', frame_index, image_index)
             elif len(params) == 1:
                 frame_index = int(params[0])
                 image_path = self.server.get_albula_image_file(frame_index)
-                self.send_text_response('OK get_test {} {}'.format(frame_index, image_path))
+                self.send_response('OK', 'get_test', frame_index, image_path)
             else:
                 self.send_text_response('ERROR:102 test illegal_arguments')
         elif cmd == 'IMAGE':
@@ -227,15 +1053,40 @@ class AlbulaRequestHandler(BLRequestHandler):
                 image_path = " ".join(params[1:])
                 errno = self.server.set_albula_image_file(frame_index, image_path)
                 if errno:
-                    self.send_text_response('ERROR:{} set_image {} {}'.format(errno, frame_index, image_path))
+                    self.send_response('ERROR:{}'.format(errno), 'set_image', frame_index, image_path)
                 else:
-                    self.send_text_response('OK set_image {} {}'.format(frame_index, image_path))
+                    self.send_response('OK', 'set_image', frame_index, image_path)
             elif len(params) == 1:
                 frame_index = int(params[0])
                 image_path = self.server.get_albula_image_file(frame_index)
-                self.send_text_response('OK get_image {} {}'.format(frame_index, image_path))
+                self.send_response('OK', 'get_image', frame_index, image_path)
             else:
                 self.send_text_response('ERROR:102 image illegal_arguments')
+        elif cmd == 'IMAGE_NOWAIT':
+            if len(params) > 1:
+                frame_index = int(params[0])
+                image_path = " ".join(params[1:])
+                self.server.submit_albula_image_file(frame_index, image_path)
+                self.send_response('OK', 'set_image_nowait', frame_index, image_path)
+            else:
+                self.send_text_response('ERROR:102 image_nowait illegal_arguments')
+        elif cmd == 'IMAGE_WAIT':
+            if len(params) == 1 or len(params) == 2:
+                frame_index = int(params[0])
+                timeout = float(params[1]) if len(params) == 2 else None
+                try:
+                    pending = self.server.wait_albula_image_file(frame_index, timeout)
+                except FutureTimeoutError:
+                    self.send_response('ERROR:105', 'image_wait', frame_index, 'timeout')
+                    return
+                if pending is None:
+                    self.send_response('ERROR:104', 'image_wait', frame_index, 'no_pending_image')
+                elif pending[1]:
+                    self.send_response('ERROR:{}'.format(pending[1]), 'set_image', frame_index, pending[0])
+                else:
+                    self.send_response('OK', 'set_image', frame_index, pending[0])
+            else:
+                self.send_text_response('ERROR:102 image_wait illegal_arguments')
         elif cmd == 'RECT':
             if len(params) == 5:
                 frame_index = int(params[0])
@@ -245,16 +1096,16 @@ class AlbulaRequestHandler(BLRequestHandler):
                 height = int(params[4])
                 errno = self.server.set_albula_rect(frame_index, left, top, width, height)
                 if errno:
-                    self.send_text_response('ERROR:{} set_rect {} {} {} {} {}'.format(errno, frame_index, left, top, width, height))
+                    self.send_response('ERROR:{}'.format(errno), 'set_rect', frame_index, left, top, width, height)
                 else:
-                    self.send_text_response('OK set_rect {} {} {} {} {}'.format(frame_index, left, top, width, height))
+                    self.send_response('OK', 'set_rect', frame_index, left, top, width, height)
             elif len(params) == 1:
                 frame_index = int(params[0])
                 rect = self.server.get_albula_rect(frame_index)
                 if rect != None:
-                    self.send_text_response('OK get_rect {} {} {} {} {}'.format(frame_index, rect.left, rect.top, rect.width, rect.height))
+                    self.send_response('OK', 'get_rect', frame_index, rect.left, rect.top, rect.width, rect.height)
                 else:
-                    self.send_text_response('OK get_rect {} {} {} {} {}'.format(frame_index, -1, -1, -1, -1))
+                    self.send_response('OK', 'get_rect', frame_index, -1, -1, -1, -1)
             else:
                 self.send_text_response('ERROR:102 rect illegal_arguments')
         elif cmd == 'LIMIT':
@@ -264,32 +1115,203 @@ class AlbulaRequestHandler(BLRequestHandler):
                 upper_limit = float(params[2])
                 errno = self.server.set_albula_count_limit(frame_index, lower_limit, upper_limit)
                 if errno:
-                    self.send_text_response('ERROR:{} set_limit {} {} {}'.format(errno, frame_index, lower_limit, upper_limit))
+                    self.send_response('ERROR:{}'.format(errno), 'set_limit', frame_index, lower_limit, upper_limit)
                 else:
-                    self.send_text_response('OK set_limit {} {} {}'.format(frame_index, lower_limit, upper_limit))
+                    self.send_response('OK', 'set_limit', frame_index, lower_limit, upper_limit)
             elif len(params) == 1:
                 frame_index = int(params[0])
                 count_limit = self.server.get_albula_count_limit(frame_index)
                 if (count_limit != None):
-                    self.send_text_response('OK get_limit {} {} {}'.format(frame_index, count_limit["lowerCountLimit"], count_limit["upperCountLimit"]))
+                    self.send_response('OK', 'get_limit', frame_index, count_limit["lowerCountLimit"], count_limit["upperCountLimit"])
                 else:
-                    self.send_text_response('OK get_limit {} {} {}'.format(frame_index, None, None))
+                    self.send_response('OK', 'get_limit', frame_index, None, None)
             else:
                 self.send_text_response('ERROR:102 limit illegal_arguments')
         elif cmd == 'COUNT':
             if len(params) == 1:
                 frame_index = int(params[0])
                 count = self.server.get_albula_count(frame_index)
-                self.send_text_response('OK get_count {} {}'.format(frame_index, count))
+                if count is None:
+                    self.send_response('ERROR:2', 'get_count', frame_index, 'no_image')
+                else:
+                    self.send_response('OK', 'get_count', frame_index, count)
             else:
                 self.send_text_response('ERROR:102 count illegal_arguments')
+        elif cmd == 'ROI':
+            if len(params) == 6:
+                frame_index = int(params[0])
+                name = params[1]
+                left, top, width, height = [int(param) for param in params[2:]]
+                errno = self.server.set_albula_roi(frame_index, name, left, top, width, height)
+                if errno:
+                    self.send_response('ERROR:{}'.format(errno), 'set_roi', frame_index, name, left, top, width, height)
+                else:
+                    self.send_response('OK', 'set_roi', frame_index, name, left, top, width, height)
+            elif len(params) > 3 and params[2].upper() == 'MASK':
+                frame_index = int(params[0])
+                name = params[1]
+                mask_path = " ".join(params[3:])
+                errno = self.server.set_albula_roi(frame_index, name, mask_path=mask_path)
+                if errno:
+                    self.send_response('ERROR:{}'.format(errno), 'set_roi', frame_index, name, 'mask', mask_path)
+                else:
+                    self.send_response('OK', 'set_roi', frame_index, name, 'mask', mask_path)
+            elif len(params) == 2:
+                frame_index = int(params[0])
+                name = params[1]
+                roi = self.server.get_albula_roi(frame_index, name)
+                if roi is None:
+                    self.send_response('OK', 'get_roi', frame_index, name, -1, -1, -1, -1)
+                elif isinstance(roi, tuple):
+                    self.send_response('OK', 'get_roi', frame_index, name, *roi)
+                else:
+                    self.send_response('OK', 'get_roi', frame_index, name, 'mask')
+            elif len(params) == 1:
+                frame_index = int(params[0])
+                names = self.server.get_albula_roi(frame_index)
+                self.send_response('OK', 'get_roi', frame_index, *names)
+            else:
+                self.send_text_response('ERROR:102 roi illegal_arguments')
+        elif cmd == 'COUNTS':
+            if len(params) == 1:
+                frame_index = int(params[0])
+                results = self.server.get_albula_counts(frame_index)
+                if results is None:
+                    self.send_response('ERROR:2', 'get_counts', frame_index, 'no_image')
+                    return
+                fields = ['OK', 'get_counts', frame_index, len(results)]
+                for name, stats in results:
+                    fields.append(name)
+                    fields.extend(stats[stat_name] for stat_name in STAT_NAMES)
+                self.send_response(*fields)
+            else:
+                self.send_text_response('ERROR:102 counts illegal_arguments')
+        elif cmd == 'FOLLOW':
+            if len(params) == 2 and params[1].upper() == 'OFF':
+                frame_index = int(params[0])
+                errno = self.server.stop_albula_follow(frame_index)
+                if errno:
+                    self.send_response('ERROR:{}'.format(errno), 'set_follow', frame_index, 'off')
+                else:
+                    self.send_response('OK', 'set_follow', frame_index, 'off')
+            elif len(params) == 2 or len(params) == 3:
+                frame_index = int(params[0])
+                directory = params[1]
+                pattern = params[2] if len(params) == 3 else '*'
+                errno = self.server.set_albula_follow(frame_index, directory, pattern)
+                if errno:
+                    self.send_response('ERROR:{}'.format(errno), 'set_follow', frame_index, directory, pattern)
+                else:
+                    self.send_response('OK', 'set_follow', frame_index, directory, pattern)
+            elif len(params) == 1:
+                frame_index = int(params[0])
+                follow = self.server.get_albula_follow(frame_index)
+                if follow is not None:
+                    self.send_response('OK', 'get_follow', frame_index, follow['directory'], follow['pattern'], follow['method'])
+                else:
+                    self.send_response('OK', 'get_follow', frame_index, 'off')
+            else:
+                self.send_text_response('ERROR:102 follow illegal_arguments')
+        elif cmd == 'RESULT':
+            if len(params) == 1:
+                frame_index = int(params[0])
+                result = self.server.get_albula_follow_result(frame_index)
+                if result is None:
+                    self.send_response('OK', 'get_result', frame_index, 0, None, None, 0)
+                else:
+                    fields = ['OK', 'get_result', frame_index, result['sequence'], result['path'], result['count'], len(result['counts'])]
+                    for name, stats in result['counts']:
+                        fields.append(name)
+                        fields.extend(stats[stat_name] for stat_name in STAT_NAMES)
+                    self.send_response(*fields)
+            else:
+                self.send_text_response('ERROR:102 result illegal_arguments')
+        elif cmd == 'CACHE':
+            if len(params) == 2:
+                max_megabytes = float(params[0])
+                prefetch_count = int(params[1])
+                errno = self.server.set_albula_cache(int(max_megabytes * 1024 * 1024), prefetch_count)
+                if errno:
+                    self.send_response('ERROR:{}'.format(errno), 'set_cache', max_megabytes, prefetch_count)
+                else:
+                    self.send_response('OK', 'set_cache', max_megabytes, prefetch_count)
+            elif len(params) == 0:
+                cache = self.server.get_albula_cache()
+                self.send_response('OK', 'get_cache', cache['max_bytes'] / (1024 * 1024), cache['prefetch_count'],
+                                   cache['entries'], cache['bytes'], cache['hits'], cache['misses'])
+            else:
+                self.send_text_response('ERROR:102 cache illegal_arguments')
+        elif cmd == 'DISPLAY':
+            if len(params) in (1, 2) and params[0].upper() == 'ON':
+                errno = self.server.open_albula_display()
+                if not errno and len(params) == 2:
+                    self.server.set_albula_display_interval(float(params[1]) / 1000)
+                if errno:
+                    self.send_response('ERROR:{}'.format(errno), 'set_display', 'on')
+                else:
+                    self.send_response('OK', 'set_display', 'on', self.server.get_albula_display()['interval'] * 1000)
+            elif len(params) == 1 and params[0].upper() == 'OFF':
+                self.server.close_albula_display()
+                self.send_text_response('OK set_display off')
+            elif len(params) == 1 and params[0].upper() == 'NOW':
+                errno = self.server.refresh_albula_display()
+                if errno:
+                    self.send_response('ERROR:{}'.format(errno), 'refresh_display')
+                else:
+                    self.send_text_response('OK refresh_display')
+            elif len(params) == 0:
+                display = self.server.get_albula_display()
+                self.send_response('OK', 'get_display', 'on' if display['on'] else 'off', display['interval'] * 1000,
+                                   display['updates'])
+            else:
+                self.send_text_response('ERROR:102 display illegal_arguments')
+        elif cmd == 'READER':
+            if len(params) == 1 and params[0].upper() in ('ALBULA', 'NATIVE'):
+                reader = params[0].lower()
+                errno = self.server.set_albula_reader(reader == 'native')
+                if errno:
+                    self.send_response('ERROR:{}'.format(errno), 'set_reader', reader)
+                else:
+                    self.send_response('OK', 'set_reader', reader)
+            elif len(params) == 0:
+                reader = 'native' if self.server.get_albula_reader() else 'albula'
+                self.send_response('OK', 'get_reader', reader)
+            else:
+                self.send_text_response('ERROR:102 reader illegal_arguments')
         else:
-            self.send_text_response('ERROR:101 {} unknown_command'.format(cmd))
+            self.send_response('ERROR:101', cmd, 'unknown_command')
 
 
 if __name__ == '__main__':
+    # "--asyncio" selects the asyncio server core instead of socketserver.TCPServer.
+    use_asyncio = '--asyncio' in sys.argv
+    if use_asyncio:
+        sys.argv.remove('--asyncio')
+
+    # "--headless" starts the server without the ALBULA window ("display on" opens it).
+    headless = '--headless' in sys.argv
+    if headless:
+        sys.argv.remove('--headless')
+
+    # "--native" decodes CBF files with the native reader even if ALBULA is available.
+    native_reader = '--native' in sys.argv
+    if native_reader:
+        sys.argv.remove('--native')
+
+    # "--metrics=PORT" exports STATS in the Prometheus text format.
+    # "--state=FILE" saves the configuration to FILE and restores it at startup.
+    metrics_port = None
+    state_file = None
+    for arg in list(sys.argv):
+        if arg.startswith('--metrics='):
+            metrics_port = int(arg[len('--metrics='):])
+            sys.argv.remove(arg)
+        elif arg.startswith('--state='):
+            state_file = arg[len('--state='):]
+            sys.argv.remove(arg)
+
     if len(sys.argv) != 2 and len(sys.argv) != 3:
-        print("Invalid arguments.\nUsage: python albula_tcp_server.py ADDRESS_OR_PORT [BASE_DIR]")
+        print("Invalid arguments.\nUsage: python albula_tcp_server.py [--asyncio] [--native] [--headless] [--metrics=PORT] [--state=FILE] ADDRESS_OR_PORT [BASE_DIR]")
         sys.exit()
 
     if re.match(r'^[0-9]+$', sys.argv[1]):
@@ -301,18 +1323,24 @@ if __name__ == '__main__':
             # first argument consists of address and port, e.g., "127.0.0.1:10001"
             server_address = matched.group(1), int(matched.group(2))
         else:
-            print("Invalid ADDRESS_OR_PORT.\nUsage: python albula_tcp_server.py ADDRESS_OR_PORT [BASE_DIR]")
+            print("Invalid ADDRESS_OR_PORT.\nUsage: python albula_tcp_server.py [--asyncio] [--native] [--headless] [--metrics=PORT] [--state=FILE] ADDRESS_OR_PORT [BASE_DIR]")
             sys.exit()
 
     image_base_dir = sys.argv[2] if len(sys.argv) == 3 else './'
 
     # print(server_address, image_base_dir)
 
+    if metrics_port is not None:
+        start_metrics_server(metrics_port)
+
     # initialize a server.
-    server = AlbulaTCPServer(server_address, AlbulaRequestHandler, base_dir=sys.argv[2])
+    server_class = AlbulaAsyncServer if use_asyncio else AlbulaTCPServer
+    server = server_class(server_address, AlbulaRequestHandler, base_dir=image_base_dir, native_reader=native_reader,
+                          headless=headless, state_file=state_file)
 
-    # show an Albula window with a single subframe.
-    server.set_albula_frame_number(1)
+    # show an Albula window with a single subframe, unless the frames have been restored.
+    if not server.state_restored:
+        server.set_albula_frame_number(1)
 
     # run the server.
     server.serve_forever()
@@ -0,0 +1,200 @@
+"""asyncio-based alternative to socketserver.TCPServer / ThreadingTCPServer.
+
+`AsyncBLServer` hosts the same request handler classes as the socketserver
+servers (subclasses of `bl_tcp_server.BLRequestHandler`) without modifying them:
+
+* One event loop owns every connection, so an idle client costs one socket
+  and a coroutine rather than an OS thread.
+* `process_command` is run in a bounded thread pool, because the handlers
+  call blocking device APIs (Pixet, ALBULA). Statements from one client are
+  still processed in order.
+* Statements that may wait for long (`is_blocking` of the handler, e.g.,
+  ACQUIRE or JOB_WAIT) are run in a second pool of `max_waiting` threads,
+  so that they do not hold up quick commands such as STATS or IS_RUNNING.
+* The number of other statements in flight is capped. While the cap is reached,
+  the server stops reading from sockets and TCP flow control pushes back
+  on the clients.
+* Responses are written through the event loop. A worker waits for a slow
+  client to drain its send buffer only up to `send_timeout`, after which
+  that client is disconnected, so it cannot hold up the others.
+
+The class follows the socketserver interface (`serve_forever`, `shutdown`,
+`server_close`, `server_address`) so that it can replace `TCPServer` in the
+entry points and in `QUIT` handling.
+"""
+
+import asyncio
+import socket
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from bl_tcp_server import MESSAGE_HEADER, MESSAGE_MAGIC, ProtocolError
+
+
+class AsyncRequest(object):
+    """Socket-like object given to a request handler as `self.request`.
+
+    Only the subset of the socket API used by the handlers is provided.
+    `sendall` may be called from any thread other than the event loop thread.
+    """
+
+    def __init__(self, loop, writer, send_timeout=None):
+        self.loop = loop
+        self.writer = writer
+        self.send_timeout = send_timeout
+
+    def sendall(self, data):
+        future = asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self.loop)
+        try:
+            future.result(self.send_timeout)
+        except TimeoutError:
+            future.cancel()
+            self.loop.call_soon_threadsafe(self.writer.close)
+            raise socket.timeout('send timed out')
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+
+class AsyncBLServer(object):
+    """TCP server running request handlers on an asyncio event loop."""
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True,
+                 max_workers=4, max_pending=16, send_timeout=30.0, max_waiting=32):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.max_workers = max_workers
+        self.max_waiting = max_waiting
+        self.max_pending = max_pending
+        self.send_timeout = send_timeout
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.executor = None
+        self.wait_executor = None
+        self.loop = None
+        self._stop = None
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+        if bind_and_activate:
+            try:
+                self.socket.bind(self.server_address)
+                self.server_address = self.socket.getsockname()
+                self.socket.listen(128)
+            except Exception:
+                self.server_close()
+                raise
+
+    def serve_forever(self):
+        """Run the event loop until `shutdown` is called."""
+
+        self._is_shut_down.clear()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        """Stop `serve_forever` and wait until it returns.
+        Must be called from a thread other than the event loop thread.
+        """
+
+        if self.loop is not None and self._stop is not None:
+            self.loop.call_soon_threadsafe(self._stop.set)
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        # like TCPServer, closing the listening socket also ends the service.
+        if self.loop is not None and self._stop is not None:
+            self.loop.call_soon_threadsafe(self._stop.set)
+        self.socket.close()
+
+    def handle_error(self, request, client_address):
+        """Called when a handler raises an exception; mirrors socketserver."""
+
+        print('-' * 40, file=sys.stderr)
+        print('Exception occurred during processing of request from {}'.format(client_address), file=sys.stderr)
+        traceback.print_exc()
+        print('-' * 40, file=sys.stderr)
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._pending = asyncio.Semaphore(self.max_pending)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.wait_executor = ThreadPoolExecutor(max_workers=self.max_waiting)
+
+        server = await asyncio.start_server(self._handle_connection, sock=self.socket)
+        try:
+            async with server:
+                await self._stop.wait()
+        finally:
+            self.executor.shutdown(wait=False)
+            self.wait_executor.shutdown(wait=False)
+            self.loop = None
+
+    async def _read_message(self, reader):
+        """Read a binary-protocol message and return its payload (None at EOF)."""
+
+        try:
+            header = await reader.readexactly(MESSAGE_HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            return None
+        magic, _, _, length = MESSAGE_HEADER.unpack(header)
+        if magic != MESSAGE_MAGIC:
+            raise ProtocolError('invalid message header')
+        return await reader.readexactly(length)
+
+    async def _handle_connection(self, reader, writer):
+        request = AsyncRequest(self.loop, writer, self.send_timeout)
+        client_address = writer.get_extra_info('peername')[:2]
+
+        # create a handler without running BaseRequestHandler.__init__,
+        # which would drive the blocking setup/handle/finish sequence.
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.request = request
+        handler.client_address = client_address
+        handler.server = self
+
+        try:
+            handler.setup()
+            sock = writer.get_extra_info('socket')
+            if sock is not None:
+                handler.configure_socket(sock)
+            while True:
+                if handler.binary_protocol:
+                    line = await self._read_message(reader)
+                else:
+                    line = await reader.readline() or None
+                if line is None:
+                    break
+                line = line.decode('ascii')
+                if handler.is_blocking(line):
+                    # at most one per connection, as the statements of a client are sequential.
+                    keep_open = await self.loop.run_in_executor(self.wait_executor, handler.process_line, line)
+                else:
+                    async with self._pending:
+                        keep_open = await self.loop.run_in_executor(self.executor, handler.process_line, line)
+                if not keep_open:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # the server is shutting down.
+            pass
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            try:
+                handler.finish()
+            finally:
+                writer.close()
@@ -0,0 +1,156 @@
+"""Load test of the TPX3 and Albula servers against simulated back ends.
+
+The servers are started in-process on ephemeral ports with the simulators of
+bl_sim.py, and many concurrent `BLClient`s send command sequences modelled on
+SPEC scans. For each server the report lists per-command latency percentiles,
+commands per second and frame bytes per second.
+
+Usage: python bl_bench.py [--server tpx3|albula|all] [--clients N] [--iterations N]
+                          [--asyncio] [--latency SEC] [--acq-time SEC] [--size PIXELS]
+                          [--display-latency SEC] [--headless]
+"""
+
+import argparse
+import threading
+import time
+
+import bl_sim
+from bl_tcp_client import BLClient
+
+
+class BenchmarkResult(object):
+    """Client-side latencies per command and transferred frame bytes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.frame_bytes = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def add(self, command, seconds, response):
+        with self.lock:
+            self.latencies.setdefault(command, []).append(seconds)
+            if not response.ok:
+                self.errors += 1
+            if response.data is not None:
+                self.frame_bytes += len(response.data) if isinstance(response.data, bytes) else response.data.nbytes
+
+    def report(self, title):
+        total = sum(len(values) for values in self.latencies.values())
+        lines = ['{}: {} commands in {:.3f} s, {:.1f} commands/s, {:.1f} frame MB/s, {} errors'.format(
+            title, total, self.elapsed, total / self.elapsed, self.frame_bytes / self.elapsed / 1e6, self.errors)]
+        lines.append('  {:<12} {:>7} {:>10} {:>10} {:>10} {:>10}'.format('command', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+        for command in sorted(self.latencies):
+            values = sorted(self.latencies[command])
+            lines.append('  {:<12} {:>7} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                command, len(values), percentile(values, 0.5) * 1e3, percentile(values, 0.9) * 1e3,
+                percentile(values, 0.99) * 1e3, values[-1] * 1e3))
+        return '\n'.join(lines)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_clients(server_address, scripts, iterations):
+    """Run one thread per script; each sends its commands `iterations` times on its own connection."""
+
+    result = BenchmarkResult()
+
+    def run(script):
+        with BLClient(server_address[0], server_address[1]) as client:
+            for _ in range(iterations):
+                for message in script:
+                    start = time.time()
+                    response = client.command(message)
+                    result.add(message.split(' ')[0].upper(), time.time() - start, response)
+
+    threads = [threading.Thread(target=run, args=(script,)) for script in scripts]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result.elapsed = time.time() - start
+    return result
+
+
+def start_server(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def stop_server(server, thread):
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def bench_tpx3(args):
+    device = bl_sim.SimulatedTpx3(width=args.size, height=args.size, latency=args.latency)
+    namespace = bl_sim.load_tpx3_server(bl_sim.SimulatedPixet([device]))
+    # make LAST_FRAME valid from the start.
+    device.doSimpleAcquisition(1, 0.0, bl_sim.SimulatedPixet.PX_FTYPE_NONE, '')
+
+    if args.asyncio:
+        from bl_async_server import AsyncBLServer
+        server = AsyncBLServer(('127.0.0.1', 0), namespace['TPX3RequestHandler'], max_workers=args.workers)
+    else:
+        import socketserver
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), namespace['TPX3RequestHandler'])
+        server.daemon_threads = True
+    thread = start_server(server)
+
+    # one client drives the acquisitions as a SPEC scan does; the others monitor.
+    scripts = [['ACQUIRE 0 {}'.format(args.acq_time), 'IS_RUNNING', 'LAST_FRAME']]
+    scripts += [['IS_RUNNING', 'INFO', 'LAST_FRAME']] * (args.clients - 1)
+    try:
+        return run_clients(server.server_address, scripts, args.iterations)
+    finally:
+        stop_server(server, thread)
+
+
+def bench_albula(args):
+    bl_sim.install_albula(bl_sim.SimulatedAlbula(read_latency=args.latency, display_latency=args.display_latency))
+    import albula_tcp_server
+
+    server_class = albula_tcp_server.AlbulaAsyncServer if args.asyncio else albula_tcp_server.AlbulaTCPServer
+    server = server_class(('127.0.0.1', 0), albula_tcp_server.AlbulaRequestHandler, det_num=args.clients,
+                          headless=args.headless)
+    thread = start_server(server)
+
+    scripts = []
+    for i in range(args.clients):
+        scripts.append(['IMAGE {} scan_{:0>6}.cbf'.format(i, i), 'RECT {} 10 10 100 50'.format(i),
+                        'LIMIT {} 0 1000000'.format(i), 'COUNT {}'.format(i)])
+    try:
+        return run_clients(server.server_address, scripts, args.iterations)
+    finally:
+        stop_server(server, thread)
+        server.close_albula()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the servers with simulated back ends.')
+    parser.add_argument('--server', choices=('tpx3', 'albula', 'all'), default='all')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--asyncio', action='store_true', help='use the asyncio server core')
+    parser.add_argument('--workers', type=int, default=4, help='worker threads of the asyncio core')
+    parser.add_argument('--latency', type=float, default=0.001, help='simulated device/file latency in seconds')
+    parser.add_argument('--acq-time', type=float, default=0.001, help='acquisition time in seconds')
+    parser.add_argument('--size', type=int, default=256, help='TPX3 frame width and height')
+    parser.add_argument('--display-latency', type=float, default=0.0, help='simulated ALBULA display latency in seconds')
+    parser.add_argument('--headless', action='store_true', help='run the Albula server without its window')
+    args = parser.parse_args()
+
+    if args.server in ('tpx3', 'all'):
+        print(bench_tpx3(args).report('tpx3'))
+    if args.server in ('albula', 'all'):
+        print(bench_albula(args).report('albula'))
@@ -0,0 +1,244 @@
+"""Native reader of CBF (Crystallographic Binary File) images written by
+DECTRIS PILATUS/EIGER detectors.
+
+`read_cbf` memory-maps a file, parses the MIME header of its binary section
+and decodes the "x-CBF_BYTE_OFFSET" compressed payload with NumPy:
+the escape markers (0x80 for a 16-bit delta, 0x8000 for a 32-bit delta, ...)
+are classified with array operations (only the 0x80 bytes overlapping another
+one are walked in Python, to discard those inside escaped values), and the
+deltas are then assembled and integrated by vectorized operations.
+
+`CbfImage` wraps a decoded array with the part of the `dectris.albula.DImage`
+interface the Albula server uses (width, height, data and mean), so that
+images can be counted without ALBULA. `write_cbf` writes an array in the same
+format, e.g., for simulators.
+"""
+
+import mmap
+import re
+
+import numpy as np
+
+
+BINARY_MARKER = b'\x0c\x1a\x04\xd5'
+HEADER_FIELD = re.compile(br'^\s*(X-Binary-[A-Za-z-]+|Content-Type|conversions)\s*[:=]\s*"?([^";\r\n]*)"?', re.M)
+
+
+def parse_binary_header(text):
+    """Return a dict of the MIME fields (X-Binary-Size, conversions, ...) in the header text."""
+
+    return dict((key.decode('ascii'), value.strip().decode('ascii')) for key, value in HEADER_FIELD.findall(text))
+
+
+def decode_byte_offset(buffer, count):
+    """Decode `count` values from a byte-offset compressed buffer. Return an int64 array."""
+
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+
+    # the length of the escape each 0x80 byte would start (3, 7 or 15 bytes).
+    candidates = np.flatnonzero(raw == 0x80)
+    padded = np.concatenate((raw, np.zeros(7, dtype=np.uint8)))
+    short = (padded[candidates + 1] != 0x00) | (padded[candidates + 2] != 0x80)
+    medium = ~short & ((padded[candidates + 3] != 0x00) | (padded[candidates + 4] != 0x00)
+                       | (padded[candidates + 5] != 0x00) | (padded[candidates + 6] != 0x80))
+    lengths = np.where(short, 3, np.where(medium, 7, 15))
+
+    # a 0x80 byte inside the value of a preceding escape is not a marker. Only the candidates
+    # covering or covered by another one are in question; they are walked in order, keeping
+    # a candidate if it starts at or past the end of the last marker kept.
+    markers = np.ones(len(candidates), dtype=bool)
+    if len(candidates) > 1:
+        covering = candidates[:-1] + lengths[:-1] > candidates[1:]
+        covered = np.maximum.accumulate(candidates + lengths)[:-1] > candidates[1:]
+        contested = np.flatnonzero(np.concatenate((covering, [False])) | np.concatenate(([False], covered)))
+        next_free = 0
+        for i, p, length in zip(contested.tolist(), candidates[contested].tolist(), lengths[contested].tolist()):
+            if p < next_free:
+                markers[i] = False
+            else:
+                next_free = p + length
+    ends = candidates[markers] + lengths[markers]
+    if len(ends) and ends[-1] > len(raw):
+        raise ValueError('truncated byte-offset data: escape at byte {} of {}'.format(
+            candidates[markers][-1], len(raw)))
+    starts =tuple(candidates[markers & (lengths == length)] for length in (3, 7, 15))
+
+    # drop the bytes following each marker; the marker stays as a placeholder of the delta.
+    keep = np.ones(len(raw), dtype=bool)
+    escapes = []
+    for kind, (skip, offset, size) in enumerate(((2, 1, 2), (6, 3, 4), (14, 7, 8))):
+        positions = starts[kind].astype(np.int64)
+        if not len(positions):
+            continue
+        for i in range(1, skip + 1):
+            keep[positions + i] = False
+        # gather the little-endian value bytes and combine them.
+        value_bytes = raw[(positions + offset)[:, np.newaxis] + np.arange(size)]
+        values = value_bytes.copy().view('<i{}'.format(size)).ravel()
+        escapes.append((positions, values))
+
+    deltas = raw[keep].view(np.int8).astype(np.int64)
+    if escapes:
+        kept = np.cumsum(keep) - 1
+        for positions, values in escapes:
+            deltas[kept[positions]] = values
+    if len(deltas) < count:
+        raise ValueError('truncated byte-offset data: {} of {} values'.format(len(deltas), count))
+    return np.cumsum(deltas[:count])
+
+
+def encode_byte_offset(data):
+    """Encode an integer array (flattened) with the byte-offset compression. Return bytes."""
+
+    values = np.asarray(data, dtype=np.int64).ravel()
+    deltas = np.diff(values, prepend=0)
+
+    small = (deltas > -128) & (deltas < 128)
+    medium = ~small & (deltas > -32768) & (deltas < 32768)
+    large = ~small & ~medium & (deltas > -2 ** 31) & (deltas < 2 ** 31)
+    huge = ~small & ~medium & ~large
+    lengths = np.where(small, 1, np.where(medium, 3, np.where(large, 7, 15)))
+    offsets = np.cumsum(lengths) - lengths
+
+    out = np.zeros(int(lengths.sum()), dtype=np.uint8)
+    out[offsets[small]] = deltas[small].astype(np.int8).view(np.uint8)
+    for mask, size, prefix in ((medium, 2, b'\x80'), (large, 4, b'\x80\x00\x80'),
+                               (huge, 8, b'\x80\x00\x80\x00\x00\x00\x80')):
+        starts = offsets[mask]
+        if not len(starts):
+            continue
+        for i, byte in enumerate(bytearray(prefix)):
+            out[starts + i] = byte
+        value_bytes = deltas[mask].astype('<i{}'.format(size)).view(np.uint8).reshape(-1, size)
+        out[(starts + len(prefix))[:, np.newaxis] + np.arange(size)] = value_bytes
+    return out.tobytes()
+
+
+def read_cbf(path):
+    """Read a byte-offset compressed CBF file. Return (2D int32 array, header dict).
+
+    The header dict holds the MIME fields of the binary section and, as 'contents',
+    the text of the header (e.g., PILATUS "# Exposure_time ..." lines).
+    Raise ValueError if the file is not such a CBF file or is incomplete.
+    """
+
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        start = mapped.find(BINARY_MARKER)
+        if start < 0:
+            raise ValueError('{}: no binary section'.format(path))
+        header = parse_binary_header(mapped[:start])
+        header['contents'] = mapped[:start].decode('latin1')
+        if 'BYTE_OFFSET' not in header.get('conversions', ''):
+            raise ValueError('{}: unsupported compression {!r}'.format(path, header.get('conversions')))
+
+        size = int(header['X-Binary-Size'])
+        width = int(header['X-Binary-Size-Fastest-Dimension'])
+        height = int(header['X-Binary-Size-Second-Dimension'])
+        count = int(header.get('X-Binary-Number-of-Elements', width * height))
+        start += len(BINARY_MARKER)
+        if start + size > len(mapped):
+            raise ValueError('{}: truncated binary section'.format(path))
+
+        # pad the payload so that the marker walk may look ahead past its end.
+        payload = memoryview(mapped)[start:start + size]
+        try:
+            values = decode_byte_offset(payload.tobytes() + b'\0' * 16, count)
+        finally:
+            payload.release()
+    finally:
+        mapped.close()
+
+    return values.astype(np.int32).reshape(height, width), header
+
+
+def write_cbf(path, data, contents=''):
+    """Write a 2D integer array as a byte-offset compressed CBF file."""
+
+    data = np.asarray(data)
+    height, width = data.shape
+    payload = encode_byte_offset(data)
+    header = '\r\n'.join([
+        '###CBF: VERSION 1.5',
+        'data_image',
+        '_array_data.header_convention "PILATUS_1.2"',
+        '_array_data.header_contents',
+        ';',
+        contents,
+        ';',
+        '_array_data.data',
+        ';',
+        '--CIF-BINARY-FORMAT-SECTION--',
+        'Content-Type: application/octet-stream;',
+        '     conversions="x-CBF_BYTE_OFFSET"',
+        'Content-Transfer-Encoding: BINARY',
+        'X-Binary-Size: {}'.format(len(payload)),
+        'X-Binary-ID: 1',
+        'X-Binary-Element-Type: "signed 32-bit integer"',
+        'X-Binary-Element-Byte-Order: LITTLE_ENDIAN',
+        'X-Binary-Number-of-Elements: {}'.format(width * height),
+        'X-Binary-Size-Fastest-Dimension: {}'.format(width),
+        'X-Binary-Size-Second-Dimension: {}'.format(height),
+        'X-Binary-Size-Padding: 4095',
+        '', ''])
+    with open(path, 'wb') as f:
+        f.write(header.encode('latin1'))
+        f.write(BINARY_MARKER)
+        f.write(payload)
+        f.write(b'\0' * 4095)
+        f.write(b'\r\n--CIF-BINARY-FORMAT-SECTION----\r\n;\r\n')
+
+
+class Rect(object):
+    """A rectangle with the interface of `dectris.albula.DRect`."""
+
+    def __init__(self, left, top, width, height):
+        self._left, self._top, self._width, self._height = left, top, width, height
+
+    def left(self):
+        return self._left
+
+    def top(self):
+        return self._top
+
+    def width(self):
+        return self._width
+
+    def height(self):
+        return self._height
+
+
+class CbfImage(object):
+    """A decoded CBF image with the interface of `dectris.albula.DImage` used for counting."""
+
+    def __init__(self, array, header=None):
+        self.array = array
+        self.header = header or {}
+
+    @classmethod
+    def read(cls, path):
+        return cls(*read_cbf(path))
+
+    def width(self):
+        return self.array.shape[1]
+
+    def height(self):
+        return self.array.shape[0]
+
+    def data(self):
+        return self.array
+
+    def mean(self, rect=None, lowerCountLimit=None, upperCountLimit=None):
+        """Return the mean of the pixels in `rect` within the count limits (0.0 if there is none)."""
+
+        array = self.array
+        if rect is not None:
+            left, top = max(rect.left(), 0), max(rect.top(), 0)
+            array = array[top:rect.top() + rect.height(), left:rect.left() + rect.width()]
+        valid = np.ones(array.shape, dtype=bool)
+        if lowerCountLimit is not None:
+            valid &= array >= lowerCountLimit
+        if upperCountLimit is not None:
+            valid &= array <= upperCountLimit
+        return float(array[valid].mean()) if valid.any() else 0.0
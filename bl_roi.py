@@ -0,0 +1,147 @@
+"""Vectorized statistics of many regions of interest (ROIs) in a detector image.
+
+A `RoiSet` holds named ROIs of two kinds:
+
+* rectangles, given by left, top, width and height in pixels;
+* masks, given by a boolean array of the image shape.
+
+`RoiSet.compute` returns, for every ROI, the sum, mean and maximum of the pixels
+within the count limits, the number of those pixels and the intensity-weighted
+centroid. All rectangles are evaluated at once from summed-area tables and all
+masks at once by a matrix product, so the cost hardly depends on the number of ROIs.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+STAT_NAMES = ('sum', 'mean', 'max', 'pixels', 'centroid_x', 'centroid_y')
+
+
+def summed_area_table(a):
+    """Return the summed-area table of a 2D array, padded with a leading row and column of zeros."""
+
+    table = np.zeros((a.shape[0] + 1, a.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(a, axis=0, dtype=np.float64), axis=1, out=table[1:, 1:])
+    return table
+
+
+class RoiSet(object):
+    """Named ROIs of one detector image."""
+
+    def __init__(self):
+        self.rects = OrderedDict()
+        self.masks = OrderedDict()
+
+    def __len__(self):
+        return len(self.rects) + len(self.masks)
+
+    def names(self):
+        return list(self.rects.keys()) + list(self.masks.keys())
+
+    def set_rect(self, name, left, top, width, height):
+        self.remove(name)
+        self.rects[name] = (left, top, width, height)
+
+    def set_mask(self, name, mask):
+        self.remove(name)
+        self.masks[name] = np.asarray(mask, dtype=bool)
+
+    def get(self, name):
+        """Return the rectangle tuple or mask array of an ROI, or None if it does not exist."""
+
+        if name in self.rects:
+            return self.rects[name]
+        return self.masks.get(name)
+
+    def remove(self, name):
+        self.rects.pop(name, None)
+        self.masks.pop(name, None)
+
+    def clear(self):
+        self.rects.clear()
+        self.masks.clear()
+
+    def compute(self, data, lower_limit=None, upper_limit=None):
+        """Compute the statistics of all ROIs in `data`, a 2D array.
+
+        Pixels outside [lower_limit, upper_limit] (e.g., gaps and bad pixels
+        flagged by negative values) and non-finite pixels are excluded.
+        Return a list of (name, stats) pairs, where stats is a dict keyed by `STAT_NAMES`.
+        """
+
+        image = np.asarray(data, dtype=np.float64)
+        valid = np.isfinite(image)
+        if lower_limit is not None:
+            valid &= image >= lower_limit
+        if upper_limit is not None:
+            valid &= image <= upper_limit
+
+        weights = np.where(valid, image, 0.0)
+        maxima = np.where(valid, image, -np.inf)
+        counts = valid.astype(np.float64)
+        xs = np.arange(image.shape[1], dtype=np.float64)[np.newaxis, :]
+        ys = np.arange(image.shape[0], dtype=np.float64)[:, np.newaxis]
+
+        results = []
+        if self.rects:
+            results.extend(self._compute_rects(weights, counts, maxima, xs, ys))
+        if self.masks:
+            results.extend(self._compute_masks(weights, counts, maxima, xs, ys))
+        return results
+
+    def _compute_rects(self, weights, counts, maxima, xs, ys):
+        height, width = weights.shape
+        names = list(self.rects.keys())
+        bounds = np.array(list(self.rects.values()), dtype=np.int64).reshape(-1, 4)
+
+        # clip rectangles to the image
+        left = np.clip(bounds[:, 0], 0, width)
+        top = np.clip(bounds[:, 1], 0, height)
+        right = np.clip(bounds[:, 0] + bounds[:, 2], left, width)
+        bottom = np.clip(bounds[:, 1] + bounds[:, 3], top, height)
+
+        def box_sums(table):
+            return table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]
+
+        sums = box_sums(summed_area_table(weights))
+        pixels = box_sums(summed_area_table(counts))
+        moment_x = box_sums(summed_area_table(weights * xs))
+        moment_y = box_sums(summed_area_table(weights * ys))
+
+        results = []
+        for i, name in enumerate(names):
+            region = maxima[top[i]:bottom[i], left[i]:right[i]]
+            maximum = region.max() if region.size else -np.inf
+            results.append((name, self._stats(sums[i], pixels[i], maximum, moment_x[i], moment_y[i])))
+        return results
+
+    def _compute_masks(self, weights, counts, maxima, xs, ys):
+        names = list(self.masks.keys())
+        stack = np.stack([mask.ravel() for mask in self.masks.values()]).astype(np.float64)
+
+        columns = np.stack([weights.ravel(), counts.ravel(), (weights * xs).ravel(), (weights * ys).ravel()], axis=1)
+        sums, pixels, moment_x, moment_y = stack.dot(columns).T
+
+        results = []
+        for i, name in enumerate(names):
+            region = maxima.ravel()[self.masks[name].ravel()]
+            maximum = region.max() if region.size else -np.inf
+            results.append((name, self._stats(sums[i], pixels[i], maximum, moment_x[i], moment_y[i])))
+        return results
+
+    @staticmethod
+    def _stats(total, pixels, maximum, moment_x, moment_y):
+        if pixels > 0:
+            mean = total / pixels
+        else:
+            mean = float('nan')
+        if total != 0:
+            centroid = (moment_x / total, moment_y / total)
+        else:
+            centroid = (float('nan'), float('nan'))
+        if not np.isfinite(maximum):
+            maximum = float('nan')
+        return {'sum': float(total), 'mean': float(mean), 'max': float(maximum), 'pixels': int(round(pixels)),
+                'centroid_x': float(centroid[0]), 'centroid_y': float(centroid[1])}
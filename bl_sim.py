@@ -0,0 +1,319 @@
+"""In-process simulators of the vendor runtimes used by the servers.
+
+* `SimulatedPixet` stands in for the `pixet` global that Pixet Pro provides to
+  tpx3_tcp_server.py, with `SimulatedTpx3` devices implementing the calls
+  the server makes (doSimpleAcquisition, lastAcqFrameRefInc, subFrames, ...).
+* `install_albula` registers a simulated `dectris.albula` module (readImage,
+  openMainFrame, DRect, image.mean, ...) so that albula_tcp_server.py can be
+  imported without ALBULA.
+
+Latencies and frame sizes are configurable so that the benchmark harness
+(bl_bench.py) can model a real detector. Frames are random sparse event
+images; NumPy is used when available.
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+import types
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import bl_tcp_server
+
+
+# Pixet Pro
+
+class SimulatedSubFrame(object):
+    def __init__(self, values):
+        self.values = values
+
+    def data(self):
+        # Pixet returns a list of values.
+        if numpy is not None:
+            return self.values.tolist()
+        return list(self.values)
+
+    def size(self):
+        return len(self.values)
+
+
+class SimulatedFrame(object):
+    def __init__(self, itot, event):
+        self.sub_frames = [SimulatedSubFrame(itot), SimulatedSubFrame(event)]
+        self.destroyed = False
+
+    def subFrames(self):
+        return self.sub_frames
+
+    def destroy(self):
+        self.destroyed = True
+
+
+def random_event_values(size, occupancy, seed=None):
+    """Return `size` int16 values with about `occupancy` of them non-zero."""
+
+    if numpy is not None:
+        rng = numpy.random.default_rng(seed)
+        values = numpy.zeros(size, dtype=numpy.int16)
+        hits = rng.random(size) < occupancy
+        values[hits] = rng.integers(1, 100, hits.sum())
+        return values
+    rng = random.Random(seed)
+    return [rng.randint(1, 99) if rng.random() < occupancy else 0 for _ in range(size)]
+
+
+class SimulatedTpx3(object):
+    """TPX3 device whose acquisitions take `acq_time * time_scale + latency` seconds."""
+
+    def __init__(self, name='Simulated TPX3 W0000_A00', width=256, height=256, latency=0.0,
+                 time_scale=1.0, occupancy=0.01):
+        self.name = name
+        self.frame_width = width
+        self.frame_height = height
+        self.latency = latency
+        self.time_scale = time_scale
+        self.occupancy = occupancy
+        self.operation_mode = None
+        self.connected = True
+        self.running = False
+        self.aborted = threading.Event()
+        self.last_frame = None
+        self.acquisitions = 0
+        self.lock = threading.Lock()
+
+    def isConnected(self):
+        return self.connected
+
+    def reconnect(self):
+        time.sleep(self.latency)
+        self.connected = True
+        return 0
+
+    def width(self):
+        return self.frame_width
+
+    def height(self):
+        return self.frame_height
+
+    def dataType(self):
+        return 1
+
+    def fullName(self):
+        return self.name
+
+    def setOperationMode(self, mode):
+        self.operation_mode = mode
+        return 0
+
+    def doSimpleAcquisition(self, count, acq_time, file_type, filename):
+        return self._acquire(count, acq_time, filename)
+
+    def doSimpleIntegralAcquisition(self, count, acq_time, file_type, filename):
+        return self._acquire(count, acq_time, filename)
+
+    def isAcquisitionRunning(self):
+        return self.running
+
+    def abortOperation(self):
+        self.aborted.set()
+        return 0
+
+    def lastAcqFrameRefInc(self):
+        return self.last_frame
+
+    def _acquire(self, count, acq_time, filename):
+        with self.lock:
+            self.running = True
+            self.aborted.clear()
+            try:
+                if self.aborted.wait(max(count, 1) * acq_time * self.time_scale + self.latency):
+                    return -1
+                self.acquisitions += 1
+                size = self.frame_width * self.frame_height
+                event = random_event_values(size, self.occupancy, self.acquisitions)
+                self.last_frame = SimulatedFrame(event, event)
+                if filename:
+                    with open(filename, 'w') as f:
+                        f.write('simulated frame {}\n'.format(self.acquisitions))
+                return 0
+            finally:
+                self.running = False
+
+
+class SimulatedPixet(object):
+    """The `pixet` global of Pixet Pro."""
+
+    PX_TPX3_OPM_EVENT_ITOT = 0
+    PX_FTYPE_NONE = 0
+    PX_FTYPE_AUTODETECT = 1
+    PX_FTYPE_PNG = 2
+
+    def __init__(self, devices=None):
+        self.devices = devices if devices is not None else [SimulatedTpx3()]
+        self.events = {}
+
+    def devicesTpx3(self):
+        return list(self.devices)
+
+    def registerEvent(self, name, callback, data):
+        self.events[name] = (callback, data)
+
+    def exitPixet(self):
+        callback, data = self.events.get('Exit', (None, None))
+        if callback is not None:
+            callback(data)
+
+
+def load_tpx3_server(pixet=None, device_index=0):
+    """Execute tpx3_tcp_server.py the way Pixet Pro does and return its namespace.
+
+    As in Pixet Pro, the names of bl_tcp_server.py and `pixet` are provided as globals.
+    `DEVICES` is filled with a context per device and `TPX3RequestHandler` serves the selected
+    one by default (`handler_class` returns a handler for another); the `__main__` block is not run.
+    """
+
+    if pixet is None:
+        pixet = SimulatedPixet()
+    namespace = dict(vars(bl_tcp_server))
+    namespace.update({'__name__': 'tpx3_tcp_server', 'pixet': pixet})
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tpx3_tcp_server.py')
+    with open(path) as f:
+        exec(compile(f.read(), path, 'exec'), namespace)
+    for index, device in enumerate(pixet.devicesTpx3()):
+        namespace['DEVICES'].append(namespace['DeviceContext'](device, index))
+    namespace['TPX3RequestHandler'].context = namespace['DEVICES'][device_index]
+    return namespace
+
+
+# ALBULA
+
+class DNoFileAccessException(Exception):
+    pass
+
+
+class DNoObject(Exception):
+    pass
+
+
+class DRect(object):
+    def __init__(self, left, top, width, height):
+        self._left, self._top, self._width, self._height = left, top, width, height
+
+    def left(self):
+        return self._left
+
+    def top(self):
+        return self._top
+
+    def width(self):
+        return self._width
+
+    def height(self):
+        return self._height
+
+
+class DImage(object):
+    def __init__(self, array):
+        self.array = array
+
+    def width(self):
+        return self.array.shape[1]
+
+    def height(self):
+        return self.array.shape[0]
+
+    def data(self):
+        return self.array
+
+    def mean(self, rect=None, lowerCountLimit=None, upperCountLimit=None):
+        array = self.array
+        if rect is not None:
+            array = array[rect.top():rect.top() + rect.height(), rect.left():rect.left() + rect.width()]
+        valid = numpy.ones(array.shape, dtype=bool)
+        if lowerCountLimit is not None:
+            valid &= array >= lowerCountLimit
+        if upperCountLimit is not None:
+            valid &= array <= upperCountLimit
+        return float(array[valid].mean()) if valid.any() else 0.0
+
+
+class SimulatedSubFrameView(object):
+    def __init__(self, albula):
+        self.albula = albula
+        self.image = None
+
+    def setActiveColor(self, r, g, b):
+        pass
+
+    def setNonActiveColor(self, r, g, b):
+        pass
+
+    def loadImage(self, image):
+        time.sleep(self.albula.display_latency)
+        self.image = image
+
+    def close(self):
+        pass
+
+
+class SimulatedMainFrame(object):
+    def __init__(self, albula):
+        self.albula = albula
+
+    def openSubFrame(self):
+        return SimulatedSubFrameView(self.albula)
+
+    def close(self):
+        pass
+
+
+class SimulatedAlbula(object):
+    """Settings and call counters of the simulated `dectris.albula` module."""
+
+    def __init__(self, width=487, height=195, read_latency=0.0, display_latency=0.0, require_files=False):
+        self.width = width
+        self.height = height
+        self.read_latency = read_latency
+        self.display_latency = display_latency
+        self.require_files = require_files
+        self.reads = 0
+
+    def readImage(self, path, timeout=0):
+        if self.require_files and not os.path.exists(path):
+            raise DNoFileAccessException(path)
+        time.sleep(self.read_latency)
+        self.reads += 1
+        rng = numpy.random.default_rng(abs(hash(path)) % (2 ** 32))
+        return DImage(rng.poisson(5.0, (self.height, self.width)).astype(numpy.int32))
+
+    def openMainFrame(self, disableClose=False):
+        return SimulatedMainFrame(self)
+
+    def module(self):
+        module = types.ModuleType('dectris.albula')
+        module.DNoFileAccessException = DNoFileAccessException
+        module.DNoObject = DNoObject
+        module.DRect = DRect
+        module.DImage = DImage
+        module.readImage = self.readImage
+        module.openMainFrame = self.openMainFrame
+        module.simulator = self
+        return module
+
+
+def install_albula(simulator=None):
+    """Register a simulated `dectris.albula` in sys.modules and return the simulator."""
+
+    if simulator is None:
+        simulator = SimulatedAlbula()
+    package = types.ModuleType('dectris')
+    package.albula = simulator.module()
+    sys.modules['dectris'] = package
+    sys.modules['dectris.albula'] = package.albula
+    return simulator
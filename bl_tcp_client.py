@@ -1,19 +1,406 @@
+"""Clients for the beamline TCP servers.
+
+`BLClient` keeps its connection open between commands, can send several
+commands in one write (`pipeline`) and reads each reply up to its newline,
+including multi-line replies ("OK stats N", "OK trace N") and the binary frames following
+an "OK last_frame int16 size width height byteorder" or "OK get_frame ..."
+header, which are returned as a NumPy array (sparse and zlib-encoded frames are decoded). `AsyncBLClient` is the asyncio equivalent.
+`get_client` returns a client shared per address.
+
+With `binary=True`, the client switches the connection to the length-prefixed
+binary protocol (see bl_tcp_server.py) and responses carry typed `fields`.
+"""
+
+import asyncio
+import select
 import socket
 import sys
+import threading
+import zlib
+
+from bl_tcp_server import MESSAGE_HEADER, MESSAGE_MAGIC, MESSAGE_REQUEST, ProtocolError, pack_message, unpack_fields
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DTYPE_SIZES = {'int8': 1, 'uint8': 1, 'int16': 2, 'uint16': 2, 'int32': 4, 'uint32': 4, 'int64': 8,
+               'float32': 4, 'float64': 8}
+
+# replies followed by binary data: "OK name dtype size width height byteorder ..." (images)
+# and "OK name dtype size byteorder ..." (1D arrays).
+IMAGE_REPLIES = ('last_frame', 'get_frame', 'binned', 'accumulated', 'corrected_frame')
+ARRAY_REPLIES = ('projection', 'histogram')
+# encoded frames, "OK name int16 count|nbytes width height byteorder size" (see `decode_encoded_frame`).
+ENCODED_REPLIES = ('last_frame_sparse', 'last_frame_zlib')
+
+
+class Response(object):
+    """A reply of a server: the header line, following text lines and/or a binary payload."""
+
+    def __init__(self, text, lines=None, data=None, fields=None):
+        self.text = text
+        self.words = text.split(' ')
+        self.lines = lines or []
+        self.data = data
+        self.fields = fields
+
+    @property
+    def ok(self):
+        return self.words[0] == 'OK'
+
+    def __repr__(self):
+        return 'Response({!r})'.format(self.text)
+
+
+def payload_of(words):
+    """Return ('lines', n) or ('bytes', n) describing what follows a header line, or None."""
+
+    if len(words) >= 4 and words[0] == 'OK' and words[1] in IMAGE_REPLIES + ARRAY_REPLIES:
+        return 'bytes', int(words[3]) * DTYPE_SIZES[words[2]]
+    if len(words) >= 4 and words[0] == 'OK' and words[1] == 'last_frame_sparse':
+        return 'bytes', int(words[3]) * (4 + DTYPE_SIZES[words[2]])
+    if len(words) >= 4 and words[0] == 'OK' and words[1] == 'last_frame_zlib':
+        return 'bytes', int(words[3])
+    if len(words) == 3 and words[0] == 'OK' and words[1] in ('stats', 'trace'):
+        return 'lines', int(words[2])
+    return None
+
+
+def decode_frame(words, data):
+    """Convert the binary payload of a last_frame or binned reply into an array of shape (height, width),
+    that of a get_frame reply into an array of shape (count, height, width) and others into a 1D array."""
+
+    if numpy is None:
+        return data
+    if words[1] in ENCODED_REPLIES:
+        return decode_encoded_frame(words, data)
+    if words[1] in ARRAY_REPLIES:
+        byteorder = '>' if len(words) > 4 and words[4] == 'big' else '<'
+        return numpy.frombuffer(data, dtype=numpy.dtype(words[2]).newbyteorder(byteorder))
+    byteorder = '>' if len(words) > 6 and words[6] == 'big' else '<'
+    array = numpy.frombuffer(data, dtype=numpy.dtype(words[2]).newbyteorder(byteorder))
+    if words[1] == 'get_frame' and len(words) > 8:
+        array = array.reshape(int(words[8]), int(words[5]), int(words[4]))
+    elif len(words) > 5 and int(words[4]) * int(words[5]) == array.size:
+        array = array.reshape(int(words[5]), int(words[4]))
+    return array
+
+
+def decode_encoded_frame(words, data):
+    """Convert the payload of a last_frame_sparse or last_frame_zlib reply into a dense array of shape (height, width)."""
+
+    count, width, height = int(words[3]), int(words[4]), int(words[5])
+    byteorder = '>' if words[6] == 'big' else '<'
+    dtype = numpy.dtype(words[2]).newbyteorder(byteorder)
+    if words[1] == 'last_frame_zlib':
+        return numpy.frombuffer(zlib.decompress(data), dtype=dtype).reshape(height, width)
+    indices = numpy.frombuffer(data, dtype=numpy.dtype('uint32').newbyteorder(byteorder), count=count)
+    array = numpy.zeros(width * height, dtype=dtype)
+    array[indices] = numpy.frombuffer(data, dtype=dtype, count=count, offset=4 * count)
+    return array.reshape(height, width)
+
+
+def decode_array(typecode, byteorder, shape, view):
+    if numpy is None:
+        return view.tobytes()
+    return numpy.frombuffer(view, dtype=numpy.dtype(typecode).newbyteorder(byteorder)).reshape(shape)
+
+
+def response_from_payload(payload):
+    """Build a `Response` from the payload of a binary-protocol message."""
+
+    fields = unpack_fields(payload)
+    data = None
+    scalars = []
+    for field in fields:
+        if isinstance(field, tuple):
+            data = field
+        else:
+            scalars.append(field)
+    if data is not None:
+        if len(scalars) > 6 and scalars[1] in ENCODED_REPLIES and numpy is not None:
+            data = decode_encoded_frame([str(field) for field in scalars], data[3])
+        else:
+            data = decode_array(*data)
+
+    # the lines of a multi-line reply ("OK stats N") follow its header fields.
+    lines = None
+    payload = payload_of([str(field) for field in scalars[:3]])
+    if payload is not None and payload[0] == 'lines' and payload[1]:
+        scalars, lines = scalars[:-payload[1]], scalars[-payload[1]:]
+    return Response(' '.join(str(field) for field in scalars), lines=lines, data=data, fields=scalars)
+
+
+def response_first_sequence(response):
+    """Return the sequence number of the first frame of a get_frame reply in either protocol."""
+
+    if response.fields is not None:
+        return response.fields[7]
+    return int(response.words[7])
+
+
+def request_message(message):
+    return b''.join(pack_message(MESSAGE_REQUEST, [message.rstrip('\r\n').encode('ascii')]))
+
+
+class BLClient(object):
+    """Persistent connection to a beamline TCP server."""
+
+    def __init__(self, host, port, timeout=None, binary=False):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.binary = binary
+        self.binary_active = False
+        self.sock = None
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.sock is None:
+            self.sock = socket.create_connection((self.host, self.port), self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.buffer = bytearray()
+            self.binary_active = False
+            if self.binary:
+                self.sock.sendall(b'PROTOCOL BINARY\n')
+                response = self.read_response()
+                if not response.ok:
+                    raise ProtocolError(response.text)
+                self.binary_active = True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def command(self, message):
+        """Send a command and return its `Response`."""
+
+        return self.pipeline([message])[0]
+
+    def pipeline(self, messages):
+        """Send several commands in one write and return their responses in order.
+
+        A connection closed by the server while idle is reopened. The commands are
+        sent again only if writing them failed, never once they have been written,
+        since the server may have executed them.
+        """
+
+        with self.lock:
+            if self.sock is not None and self._closed_by_server():
+                self.close()
+            while True:
+                reused = self.sock is not None
+                self.connect()
+                if self.binary_active:
+                    payload = b''.join(request_message(message) for message in messages)
+                else:
+                    payload = ''.join(message.rstrip('\r\n') + '\n' for message in messages).encode('ascii')
+                try:
+                    self.sock.sendall(payload)
+                except OSError:
+                    self.close()
+                    if not reused:
+                        raise
+                    continue
+
+                try:
+                    return [self.read_response() for _ in messages]
+                except (OSError, EOFError):
+                    self.close()
+                    raise
+
+    def _closed_by_server(self):
+        """Return True if the server has closed the idle connection (or reset it)."""
+
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            # data pushed by the server (e.g., after SUBSCRIBE) is left to `read_response`.
+            return bool(readable) and not self.sock.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            return True
+
+    def read_response(self):
+        """Read one response, e.g., a frame pushed after SUBSCRIBE."""
+
+        if self.binary_active:
+            magic, _, _, length = MESSAGE_HEADER.unpack(self._read_exact(MESSAGE_HEADER.size))
+            if magic != MESSAGE_MAGIC:
+                raise ProtocolError('invalid message header')
+            return response_from_payload(self._read_exact(length))
+
+        text = self._read_line()
+        words = text.split(' ')
+        payload = payload_of(words)
+        if payload is None:
+            return Response(text)
+        kind, size = payload
+        if kind == 'lines':
+            return Response(text, lines=[self._read_line() for _ in range(size)])
+        return Response(text, data=decode_frame(words, self._read_exact(size)))
+
+    def last_frame(self, encoding=None):
+        """Return the last frame of a TPX3 server as an array, or None if there is none.
+
+        `encoding` (SPARSE or ZLIB) reduces the bytes transferred; the frame is returned dense.
+        """
+
+        response = self.command('LAST_FRAME {}'.format(encoding) if encoding else 'LAST_FRAME')
+        return response.data if response.ok else None
+
+    def get_frames(self, first=None, last=None):
+        """Return (first sequence number, array of frames) from the ring buffer of a TPX3 server,
+        or None if the frames are no longer available."""
+
+        response = self.command(' '.join(['GET_FRAME'] + [str(n) for n in (first, last) if n is not None]))
+        if not response.ok:
+            return None
+        return response_first_sequence(response), response.data
+
+    def _read_line(self):
+        while True:
+            index = self.buffer.find(b'\n')
+            if index >= 0:
+                line = bytes(self.buffer[:index]).rstrip(b'\r')
+                del self.buffer[:index + 1]
+                return line.decode('ascii')
+            self._fill()
+
+    def _read_exact(self, size):
+        while len(self.buffer) < size:
+            self._fill()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def _fill(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise EOFError('connection closed by the server')
+        self.buffer.extend(chunk)
+
+
+class AsyncBLClient(object):
+    """asyncio variant of `BLClient`."""
+
+    def __init__(self, host, port, binary=False):
+        self.host = host
+        self.port = port
+        self.binary = binary
+        self.binary_active = False
+        self.reader = None
+        self.writer = None
+        # serializes connecting (including the PROTOCOL BINARY handshake) and pipelines.
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        async with self.lock:
+            await self._connect()
+
+    async def _connect(self):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            sock = self.writer.get_extra_info('socket')
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.binary_active = False
+            if self.binary:
+                self.writer.write(b'PROTOCOL BINARY\n')
+                response = await self.read_response()
+                if not response.ok:
+                    raise ProtocolError(response.text)
+                self.binary_active = True
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.reader = self.writer = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def command(self, message):
+        return (await self.pipeline([message]))[0]
+
+    async def pipeline(self, messages):
+        async with self.lock:
+            await self._connect()
+            if self.binary_active:
+                self.writer.write(b''.join(request_message(message) for message in messages))
+            else:
+                self.writer.write(''.join(message.rstrip('\r\n') + '\n' for message in messages).encode('ascii'))
+            await self.writer.drain()
+            return [await self.read_response() for _ in messages]
+
+    async def read_response(self):
+        if self.binary_active:
+            magic, _, _, length = MESSAGE_HEADER.unpack(await self.reader.readexactly(MESSAGE_HEADER.size))
+            if magic != MESSAGE_MAGIC:
+                raise ProtocolError('invalid message header')
+            return response_from_payload(await self.reader.readexactly(length))
+
+        text = (await self.reader.readuntil(b'\n')).rstrip(b'\r\n').decode('ascii')
+        words = text.split(' ')
+        payload = payload_of(words)
+        if payload is None:
+            return Response(text)
+        kind, size = payload
+        if kind == 'lines':
+            lines = []
+            for _ in range(size):
+                lines.append((await self.reader.readuntil(b'\n')).rstrip(b'\r\n').decode('ascii'))
+            return Response(text, lines=lines)
+        return Response(text, data=decode_frame(words, await self.reader.readexactly(size)))
+
+    async def last_frame(self, encoding=None):
+        response = await self.command('LAST_FRAME {}'.format(encoding) if encoding else 'LAST_FRAME')
+        return response.data if response.ok else None
+
+    async def get_frames(self, first=None, last=None):
+        response = await self.command(' '.join(['GET_FRAME'] + [str(n) for n in (first, last) if n is not None]))
+        if not response.ok:
+            return None
+        return response_first_sequence(response), response.data
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(host, port):
+    """Return a `BLClient` shared by all callers for the address."""
+
+    with _clients_lock:
+        client = _clients.get((host, port))
+        if client is None:
+            client = _clients[(host, port)] = BLClient(host, port)
+        return client
+
 
 def client(ip, port, message):
-    # It seems with-statement of `socket` has not been supported in Python
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((ip, port))
-    try:
+    with BLClient(ip, port) as bl_client:
         print('Sent: {}'.format(repr(message)))
-        # sock.sendall(bytes(message, 'ascii'))
-        sock.sendall(message.encode('ascii'))
-        # response = str(sock.recv(1024), 'ascii')
-        response = sock.recv(1024).decode('ascii')
-        print('Received: {}'.format(repr(response)))
-    finally:
-        sock.close()
+        response = bl_client.command(message)
+        print('Received: {}'.format(repr(response.text)))
+        for line in response.lines:
+            print('          {}'.format(repr(line)))
+        if response.data is not None:
+            print('Data: {}'.format(repr(response.data)))
 
 if __name__ == '__main__':
     """Usage: ./bl_tcp_client.py PORT MESSAGE...
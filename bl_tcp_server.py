@@ -4,57 +4,791 @@ used by socketserver.TCPServer to communcate with SPEC software.
 The basic rules of a command set this request handler handles are:
 
 * Each statement is separated by new line (LF or CR+LF).
+  Several statements may be sent in one write; they are processed in order.
 * Each statement consists of one command and optional arguments, separated by a white space.
 * "QUIT" is a special command that terminates the server.
-"""
+* "STATS [RESET]" is a special command that reports (or clears) per-command latency,
+  error, traffic and device-call statistics as "OK stats N" followed by N lines.
+* "TRACE [n | RESET | FILE name | FILE OFF]" is a special command that reports the
+  traces of the last n commands as "OK trace N" followed by N JSON lines, clears
+  them, or starts (stops) appending every trace to a JSON-lines file, which is
+  created in the `trace_dir` of the handler (refused if it is None).
+  A trace lists the phases of a command (device calls, sending, ...) as
+  [name, start, duration] with the start relative to the receipt of the command.
+* "PROTOCOL [TEXT|BINARY]" is a special command that switches the connection
+  between the text protocol above (the default) and the binary protocol below.
+
+In the binary protocol, each message starts with an 8-byte header
+`MESSAGE_HEADER` (magic b'BL', kind, flags, payload length; little endian).
+A request payload is a statement in ASCII. A response payload is a sequence of
+typed fields (see `pack_fields`): strings, 64-bit integers, 64-bit floats and
+arrays carrying their type code, byte order and shape followed by raw data.
+The reply to "PROTOCOL" is sent in the protocol of the request.
+
+Replies to the statements received in one burst are collected and written
+together once the last of them is processed (or earlier, when more than
+`output_limit` bytes are waiting), with scatter-gather `sendmsg` where the
+platform provides it. TCP_NODELAY and the socket buffer sizes are set
+per connection from class attributes of the handler.
 
-# Import statement for Python 2.7 code more compatible with Python 3.x.
-# Commented out due to inconpatibility with Pixet Pro for Advacam TimePIX3 control.
-# from __future__ import division, print_function, unicode_literals, absolute_import
+Python 3 is required (as by the servers built on this module).
+"""
 
-# `SocketServer` in Python 2.7 has been renamed to `socketserver` in Python 3.
-# However, in Python 2.7, it looks `socketserver` can be used as an alias to `SocketServer`.
 import socketserver
 
-from threading import Thread
+import json
+import os
+import socket
+import struct
+import sys
+import time
+from collections import deque
+from threading import Thread, Lock, RLock, local
+
+# high-resolution clock.
+clock = time.perf_counter
+
+
+class LatencyHistogram(object):
+    """Cumulative histogram of durations in seconds, in Prometheus bucket layout."""
+
+    bounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+              0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+    def __init__(self):
+        self.buckets = [0] * len(self.bounds)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        for i, bound in enumerate(self.bounds):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """Return an upper estimate of a percentile from the bucket bounds."""
+
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        cumulative = 0
+        for bound, n in zip(self.bounds, self.buckets):
+            cumulative += n
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class CommandStats(object):
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.device = LatencyHistogram()
+        self.errors = 0
+
+
+class DeviceTimer(object):
+    """Context manager measuring a device call (e.g., readImage or doSimpleAcquisition).
+
+    The elapsed time is recorded per operation and added to the device time of the
+    command being processed in the current thread, if any.
+    """
+
+    def __init__(self, stats, operation):
+        self.stats = stats
+        self.operation = operation
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = clock() - self.start
+        self.stats.record_device_call(self.operation, self.elapsed)
+        self.stats.add_command_device_time(self.elapsed)
+        self.stats.add_phase(self.operation, self.start, self.elapsed)
+        return False
+
+
+class PhaseTimer(object):
+    """Context manager adding a phase (e.g., sending a response) to the trace of the current command."""
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.add_phase(self.name, self.start, clock() - self.start)
+        return False
+
+
+class PhaseRecorder(object):
+    """Context manager collecting the phases recorded in the current thread into a list,
+    e.g., in a worker thread running a job on behalf of a command.
+    The list is passed to `ServerStats.add_phases` of the command.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.phases = []
+
+    def __enter__(self):
+        self.previous = getattr(self.stats.local, 'phases', None)
+        self.stats.local.phases = self.phases
+        return self.phases
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.local.phases = self.previous
+        return False
+
+
+class TraceLog(object):
+    """Bounded in-memory log of command traces, optionally appended to a JSON-lines file."""
+
+    def __init__(self, maxlen=1000):
+        self.lock = Lock()
+        self.traces = deque(maxlen=maxlen)
+        self.last_id = 0
+        self.file = None
+
+    def add(self, trace):
+        with self.lock:
+            self.last_id += 1
+            trace['id'] = self.last_id
+            self.traces.append(trace)
+            if self.file is not None:
+                self.file.write(json.dumps(trace) + '\n')
+                self.file.flush()
+
+    def recent(self, n):
+        """Return the last `n` traces, oldest first."""
+
+        with self.lock:
+            return list(self.traces)[-n:] if n > 0 else []
+
+    def reset(self):
+        with self.lock:
+            self.traces.clear()
+
+    def open_file(self, path):
+        f = open(path, 'a')
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.file = f
+
+    def close_file(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class ServerStats(object):
+    """Per-command latency, error and device-time statistics and connection traffic.
+
+    Latency runs from the start of a command until its reply is written.
+    Device time is the part of a command spent in device calls wrapped by
+    `device_call`; the rest of the latency is protocol (parsing, formatting, sending) time.
+    In addition, the phases of each command are kept as a trace in `traces`.
+
+    The replies to a burst of statements are written together (see `BLRequestHandler.handle`).
+    Between `begin_burst` and `end_burst`, commands finished with their replies still queued are
+    therefore recorded only when `commands_sent` reports the write, added as their 'send' phase.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.local = local()
+        self.connections_active = 0
+        self.traces = TraceLog()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.commands = {}
+            self.device_calls = {}
+            self.bytes_received = 0
+            self.bytes_sent = 0
+            self.connections_total = 0
+            self.start_time = time.time()
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections_active += 1
+            self.connections_total += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections_active -= 1
+
+    def add_received(self, nbytes):
+        with self.lock:
+            self.bytes_received += nbytes
+
+    def add_sent(self, nbytes):
+        with self.lock:
+            self.bytes_sent += nbytes
+
+    def device_call(self, operation):
+        return DeviceTimer(self, operation)
+
+    def phase(self, name):
+        return PhaseTimer(self, name)
+
+    def record_phases(self):
+        return PhaseRecorder(self)
+
+    def add_phase(self, name, start, seconds):
+        """Add a phase starting at `start` (a `clock` value) to the trace of the current command."""
+
+        phases = getattr(self.local, 'phases', None)
+        if phases is not None:
+            phases.append((name, start, seconds))
+
+    def add_phases(self, phases):
+        """Add phases recorded elsewhere (see `record_phases`) to the trace of the current command."""
+
+        for phase in phases:
+            self.add_phase(*phase)
+
+    def record_device_call(self, operation, seconds):
+        with self.lock:
+            histogram = self.device_calls.get(operation)
+            if histogram is None:
+                histogram = self.device_calls[operation] = LatencyHistogram()
+            histogram.add(seconds)
+
+    def add_command_device_time(self, seconds):
+        """Attribute device time measured elsewhere (e.g., in a worker thread) to the current command."""
+
+        if getattr(self.local, 'command', None) is not None:
+            self.local.device_time += seconds
+
+    def mark_error(self):
+        if getattr(self.local, 'command', None) is not None:
+            self.local.error = True
+
+    def begin_command(self, command, received=None, client=None):
+        """Start measuring a command. `received` is the `clock` value at which its statement was received."""
+
+        self.local.command = command
+        self.local.device_time = 0.0
+        self.local.error = False
+        self.local.start = clock()
+        self.local.received = received if received is not None else self.local.start
+        self.local.client = client
+        self.local.phases = [('parse', self.local.received, self.local.start - self.local.received)]
+        self.local.time = time.time()
+
+    def end_command(self, error=False, sent=True):
+        """Finish measuring the current command. `sent` is false if its reply is still queued."""
+
+        command = (self.local.command, self.local.client, self.local.time, self.local.received,
+                   self.local.start, self.local.device_time, bool(error or self.local.error), self.local.phases)
+        self.local.command = None
+        self.local.phases = None
+
+        burst = getattr(self.local, 'burst', None)
+        if burst is not None and not sent:
+            burst.append(command)
+        else:
+            self._record_command(command, clock())
+
+    def begin_burst(self):
+        """Defer recording the commands finished in this thread until their replies are sent."""
+
+        self.local.burst = []
+
+    def commands_sent(self, start, seconds):
+        """Record the deferred commands, whose replies were written from `start` for `seconds`."""
+
+        burst = getattr(self.local, 'burst', None)
+        if burst:
+            self.local.burst = []
+            for command in burst:
+                command[7].append(('send', start, seconds))
+                self._record_command(command, start + seconds)
+
+    def end_burst(self):
+        """Record the remaining deferred commands (those without a reply) and stop deferring."""
+
+        burst = getattr(self.local, 'burst', None)
+        self.local.burst = None
+        if burst:
+            end = clock()
+            for command in burst:
+                self._record_command(command, end)
+
+    def _record_command(self, command, end):
+        command, client, start_time, received, start, device_time, error, phases = command
+        self.traces.add({
+            'command': command,
+            'client': client,
+            'time': start_time,
+            'total': end - received,
+            'device': device_time,
+            'error': error,
+            'phases': [[name, phase_start - received, seconds] for name, phase_start, seconds in phases],
+        })
+
+        with self.lock:
+            stats = self.commands.get(command)
+            if stats is None:
+                stats = self.commands[command] = CommandStats()
+            stats.latency.add(end - start)
+            stats.device.add(device_time)
+            if error:
+                stats.errors += 1
+
+    def report(self):
+        """Return the statistics as a list of text lines."""
+
+        with self.lock:
+            lines = ['server uptime={:.3f} connections_active={} connections_total={} bytes_received={} bytes_sent={}'.format(
+                time.time() - self.start_time, self.connections_active, self.connections_total, self.bytes_received, self.bytes_sent)]
+            for command in sorted(self.commands):
+                stats = self.commands[command]
+                latency = stats.latency
+                lines.append('command {} count={} errors={} mean={:.6f} p50={:.6f} p90={:.6f} p99={:.6f} max={:.6f} device_mean={:.6f} protocol_mean={:.6f}'.format(
+                    command, latency.count, stats.errors, latency.mean(), latency.percentile(0.5), latency.percentile(0.9),
+                    latency.percentile(0.99), latency.max, stats.device.mean(), latency.mean() - stats.device.mean()))
+            for operation in sorted(self.device_calls):
+                histogram = self.device_calls[operation]
+                lines.append('device {} count={} mean={:.6f} p50={:.6f} p99={:.6f} max={:.6f}'.format(
+                    operation, histogram.count, histogram.mean(), histogram.percentile(0.5), histogram.percentile(0.99), histogram.max))
+        return lines
+
+    def prometheus_text(self, prefix='bl'):
+        """Return the statistics in the Prometheus text exposition format."""
+
+        def histogram_lines(name, label, histogram):
+            cumulative = 0
+            for bound, n in zip(histogram.bounds, histogram.buckets):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                out.append('{}_bucket{{{},le="{}"}} {}'.format(name, label, le, cumulative))
+            out.append('{}_sum{{{}}} {!r}'.format(name, label, histogram.total))
+            out.append('{}_count{{{}}} {}'.format(name, label, histogram.count))
+
+        out = []
+        with self.lock:
+            out.append('# TYPE {}_connections_active gauge'.format(prefix))
+            out.append('{}_connections_active {}'.format(prefix, self.connections_active))
+            for name, value in (('connections', self.connections_total), ('bytes_received', self.bytes_received), ('bytes_sent', self.bytes_sent)):
+                out.append('# TYPE {}_{}_total counter'.format(prefix, name))
+                out.append('{}_{}_total {}'.format(prefix, name, value))
+
+            out.append('# TYPE {}_command_duration_seconds histogram'.format(prefix))
+            for command in sorted(self.commands):
+                histogram_lines(prefix + '_command_duration_seconds', 'command="{}"'.format(command), self.commands[command].latency)
+            out.append('# TYPE {}_command_device_seconds histogram'.format(prefix))
+            for command in sorted(self.commands):
+                histogram_lines(prefix + '_command_device_seconds', 'command="{}"'.format(command), self.commands[command].device)
+            out.append('# TYPE {}_command_errors_total counter'.format(prefix))
+            for command in sorted(self.commands):
+                out.append('{}_command_errors_total{{command="{}"}} {}'.format(prefix, command, self.commands[command].errors))
+            out.append('# TYPE {}_device_call_duration_seconds histogram'.format(prefix))
+            for operation in sorted(self.device_calls):
+                histogram_lines(prefix + '_device_call_duration_seconds', 'operation="{}"'.format(operation), self.device_calls[operation])
+        return '\n'.join(out) + '\n'
+
+
+STATS = ServerStats()
+
+
+def start_metrics_server(port, stats=STATS):
+    """Export `stats` in the Prometheus text format at http://host:port/metrics from a daemon thread."""
+
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = stats.prometheus_text().encode('ascii')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('', port), MetricsHandler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+MESSAGE_HEADER = struct.Struct('<2sBBI')
+MESSAGE_MAGIC = b'BL'
+MESSAGE_REQUEST = 0
+MESSAGE_RESPONSE = 1
+
+FIELD_LENGTH = struct.Struct('<I')
+FIELD_INT = struct.Struct('<q')
+FIELD_FLOAT = struct.Struct('<d')
+ARRAY_HEADER = struct.Struct('<ccB')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def typed_word(word):
+    """Convert a word of a text response to int or float if possible."""
+
+    try:
+        return int(word)
+    except ValueError:
+        pass
+    try:
+        return float(word)
+    except ValueError:
+        return word
+
+
+def pack_fields(fields, data=None, typecode='B', shape=None):
+    """Encode response fields, optionally followed by an array, into a list of buffers.
+
+    `data` is not copied: it is returned as the last buffer so that it can be sent as is.
+    """
+
+    chunks = []
+    for field in fields:
+        if isinstance(field, bool) or isinstance(field, int):
+            chunks.append(b'q' + FIELD_INT.pack(field))
+        elif isinstance(field, float):
+            chunks.append(b'd' + FIELD_FLOAT.pack(field))
+        elif field is None:
+            chunks.append(b'n')
+        else:
+            encoded = str(field).encode('ascii')
+            chunks.append(b's' + FIELD_LENGTH.pack(len(encoded)) + encoded)
+
+    buffers = [b''.join(chunks)]
+    if data is not None:
+        view = memoryview(data).cast('B')
+        if shape is None:
+            shape = (view.nbytes // struct.calcsize(typecode),)
+        byteorder = b'<' if sys.byteorder == 'little' else b'>'
+        buffers.append(b'a' + ARRAY_HEADER.pack(typecode.encode('ascii'), byteorder, len(shape))
+                       + struct.pack('<{}I'.format(len(shape)), *shape))
+        buffers.append(view)
+    return buffers
+
+
+def unpack_fields(payload):
+    """Decode response fields. An array is returned as a tuple of (typecode, byteorder, shape, memoryview)."""
+
+    view = memoryview(payload)
+    fields = []
+    offset = 0
+    while offset < len(view):
+        kind = view[offset:offset + 1].tobytes()
+        offset += 1
+        if kind == b'q':
+            fields.append(FIELD_INT.unpack_from(view, offset)[0])
+            offset += FIELD_INT.size
+        elif kind == b'd':
+            fields.append(FIELD_FLOAT.unpack_from(view, offset)[0])
+            offset += FIELD_FLOAT.size
+        elif kind == b'n':
+            fields.append(None)
+        elif kind == b's':
+            length = FIELD_LENGTH.unpack_from(view, offset)[0]
+            offset += FIELD_LENGTH.size
+            fields.append(view[offset:offset + length].tobytes().decode('ascii'))
+            offset += length
+        elif kind == b'a':
+            typecode, byteorder, ndim = ARRAY_HEADER.unpack_from(view, offset)
+            offset += ARRAY_HEADER.size
+            shape = struct.unpack_from('<{}I'.format(ndim), view, offset)
+            offset += 4 * ndim
+            nbytes = struct.calcsize(typecode.decode('ascii'))
+            for n in shape:
+                nbytes *= n
+            fields.append((typecode.decode('ascii'), byteorder.decode('ascii'), shape, view[offset:offset + nbytes]))
+            offset += nbytes
+        else:
+            raise ProtocolError('unknown field type {!r}'.format(kind))
+    return fields
+
+
+def pack_message(kind, buffers):
+    """Return the list of buffers of a message, including its header."""
+
+    length = sum(memoryview(buffer).nbytes for buffer in buffers)
+    return [MESSAGE_HEADER.pack(MESSAGE_MAGIC, kind, 0, length)] + list(buffers)
+
+
+class LineReader(object):
+    """Buffered reader that splits a byte stream received from a socket into lines.
+
+    Incomplete lines are carried over to the next read, and both LF and CR+LF are
+    accepted as a line terminator. The receive size grows while the peer keeps
+    filling it (e.g., a client pipelining many commands in a single write) and
+    shrinks back once the traffic calms down.
+    """
+
+    def __init__(self, sock, min_bufsize=4096, max_bufsize=65536):
+        self.sock = sock
+        self.min_bufsize = min_bufsize
+        self.max_bufsize = max_bufsize
+        self.bufsize = min_bufsize
+        self.buffer = bytearray()
+
+    def fill(self):
+        """Receive a chunk from the socket and append it to the buffer.
+        Return False when the peer has closed the connection.
+        """
+
+        chunk = self.sock.recv(self.bufsize)
+        if not chunk:
+            return False
+
+        # adapt the receive size to the observed burst length.
+        if len(chunk) == self.bufsize and self.bufsize < self.max_bufsize:
+            self.bufsize = min(self.bufsize * 2, self.max_bufsize)
+        elif len(chunk) < self.bufsize // 4 and self.bufsize > self.min_bufsize:
+            self.bufsize = max(self.bufsize // 2, self.min_bufsize)
+
+        self.buffer.extend(chunk)
+        return True
+
+    def pop_line(self):
+        """Return the first complete line in the buffer without its terminator,
+        or None if the buffer does not contain a complete line.
+        """
+
+        index = self.buffer.find(b'\n')
+        if index < 0:
+            return None
+
+        line = bytes(self.buffer[:index])
+        del self.buffer[:index + 1]
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        return line
+
+    def pop_rest(self):
+        """Return the bytes left in the buffer (an unterminated last line) and empty it,
+        or None if the buffer is empty.
+        """
+
+        if not self.buffer:
+            return None
+        rest = bytes(self.buffer)
+        del self.buffer[:]
+        return rest
+
+    def pop_message(self):
+        """Return the payload of the first complete binary-protocol message in the buffer,
+        or None if the buffer does not contain a complete message.
+        """
+
+        if len(self.buffer) < MESSAGE_HEADER.size:
+            return None
+        magic, _, _, length = MESSAGE_HEADER.unpack_from(self.buffer)
+        if magic != MESSAGE_MAGIC:
+            raise ProtocolError('invalid message header')
+        end = MESSAGE_HEADER.size + length
+        if len(self.buffer) < end:
+            return None
+
+        payload = bytes(self.buffer[MESSAGE_HEADER.size:end])
+        del self.buffer[:end]
+        return payload
+
 
 class BLRequestHandler(socketserver.BaseRequestHandler):
 
+    # socket options of a connection (None: the OS default).
+    tcp_nodelay = True
+    send_buffer_size = None
+    recv_buffer_size = None
+
+    # bytes of collected replies above which they are written without waiting for the end of a burst.
+    output_limit = 65536
+
+    # directory in which TRACE FILE creates trace files (None: TRACE FILE is refused).
+    trace_dir = None
+
+    # commands that may block for long (e.g., waiting for an acquisition), which the
+    # asyncio server runs in a separate thread pool (see `is_blocking` and bl_async_server.py).
+    blocking_commands = ()
+
     def setup(self):
         """Called when a new client connects.
         """
 
         print("Client {}:{} connected.".format(self.client_address[0], self.client_address[1]))
+        STATS.connection_opened()
+        # the asyncio server reads the statements itself (see bl_async_server.py).
+        self.reader = LineReader(self.request) if isinstance(self.request, socket.socket) else None
+        self.binary_protocol = False
+        # serializes responses and data pushed from other threads.
+        self.send_lock = RLock()
+        # replies waiting to be written while a burst of statements is processed.
+        self.output = []
+        self.output_bytes = 0
+        self.corked = False
+        if isinstance(self.request, socket.socket):
+            self.configure_socket(self.request)
+
+    def configure_socket(self, sock):
+        """Apply `tcp_nodelay`, `send_buffer_size` and `recv_buffer_size` to the socket of the connection."""
+
+        if self.tcp_nodelay is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.tcp_nodelay))
+        if self.send_buffer_size is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+        if self.recv_buffer_size is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer_size)
 
     def handle(self):
         """Main loop for TCP/IP communication with the client.
+
+        Every complete line received in a burst is processed in order before the
+        next read; a partial line waits in the buffer until its terminator arrives,
+        or is processed as the last statement when the client closes the connection.
+        The replies to a burst are written together after its last line.
+        """
+
+        while self.reader.fill():
+            self.corked = True
+            STATS.begin_burst()
+            try:
+                while True:
+                    if self.binary_protocol:
+                        line = self.reader.pop_message()
+                    else:
+                        line = self.reader.pop_line()
+                    if line is None:
+                        break
+                    if not self.process_line(line.decode('ascii')):
+                        return
+            finally:
+                self.corked = False
+                self.flush_output()
+                STATS.end_burst()
+
+        # an incomplete binary-protocol message cannot be processed.
+        line = self.reader.pop_rest() if not self.binary_protocol else None
+        if line is not None:
+            self.process_line(line.decode('ascii'))
+
+    def is_blocking(self, line):
+        """Return True if a statement may block for long (see `blocking_commands`)."""
+
+        return line.split(' ', 1)[0].strip().upper() in self.blocking_commands
+
+    def process_line(self, line):
+        """Process a single statement.
+        Return False if the connection should be closed.
         """
 
-        data = 'dummy'
-        while data:
+        received = clock()
+        STATS.add_received(len(line) + 1)
+        line = line.strip()
 
-            data = self.request.recv(1024).decode('ascii')
-            # print(data)
-            lines = data.splitlines()
+        if len(line) == 0:
+            return True
+        elif line.upper() == 'QUIT':
+            self.send_text_response('OK quit')
+            Thread(target=shutdown_server, args=(self.server,)).start()
+            print("Quited")
+            return False
+        else:
+            words = line.split(' ')
+            if words[0].upper() == 'STATS':
+                self.process_stats_command(words[1:])
+                return True
+            elif words[0].upper() == 'TRACE':
+                self.process_trace_command(words[1:])
+                return True
+            elif words[0].upper() == 'PROTOCOL':
+                self.process_protocol_command(words[1:])
+                return True
 
-            for line in lines:
-                line = line.strip()
+            STATS.begin_command(words[0].upper(), received, '{}:{}'.format(*self.client_address[:2]))
+            try:
+                self.process_command(words[0], words[1:])
+            except Exception:
+                STATS.end_command(error=True, sent=not self.output)
+                raise
+            STATS.end_command(sent=not self.output)
+            return True
 
-                if len(line) == 0:
-                    continue
-                elif line.upper() == 'QUIT':
-                    self.send_text_response('OK quit')
-                    Thread(target=shutdown_server, args=(self.server,)).start()
-                    print("Quited")
+    def process_stats_command(self, params):
+        if len(params) == 1 and params[0].upper() == 'RESET':
+            STATS.reset()
+            self.send_text_response('OK stats_reset')
+        elif len(params) == 0:
+            lines = STATS.report()
+            self.send_text_response('\n'.join(['OK stats {}'.format(len(lines))] + lines))
+        else:
+            self.send_text_response('ERROR:102 stats illegal_arguments')
+
+    def process_trace_command(self, params):
+        if len(params) == 1 and params[0].upper() == 'RESET':
+            STATS.traces.reset()
+            self.send_text_response('OK trace_reset')
+        elif len(params) == 2 and params[0].upper() == 'FILE':
+            if params[1].upper() == 'OFF':
+                STATS.traces.close_file()
+            else:
+                # only a plain file name in `trace_dir`.
+                name = params[1]
+                if self.trace_dir is None or os.path.basename(name) != name or name in ('.', '..'):
+                    self.send_text_response('ERROR:102 trace illegal_arguments')
+                    return
+                try:
+                    STATS.traces.open_file(os.path.join(self.trace_dir, name))
+                except (IOError, OSError):
+                    self.send_response('ERROR:2', 'trace_file', name)
                     return
-                else:
-                    words = line.split(' ')
-                    self.process_command(words[0], words[1:])
+            self.send_response('OK', 'trace_file', params[1])
+        elif len(params) == 0 or (len(params) == 1 and params[0].isdigit()):
+            lines = [json.dumps(trace) for trace in STATS.traces.recent(int(params[0]) if params else 10)]
+            self.send_text_response('\n'.join(['OK trace {}'.format(len(lines))] + lines))
+        else:
+            self.send_text_response('ERROR:102 trace illegal_arguments')
+
+    def process_protocol_command(self, params):
+        if len(params) == 1 and params[0].upper() in ('TEXT', 'BINARY'):
+            protocol = params[0].lower()
+            self.send_response('OK', 'protocol', protocol)
+            self.binary_protocol = protocol == 'binary'
+        elif len(params) == 0:
+            self.send_response('OK', 'protocol', 'binary' if self.binary_protocol else 'text')
+        else:
+            self.send_text_response('ERROR:102 protocol illegal_arguments')
 
     def finish(self):
         """Called when the client closes the connection.
         """
 
+        STATS.connection_closed()
         print('Client {}:{} disconnected.'.format(self.client_address[0],  self.client_address[1]))
 
     def process_command(self, cmd, params):
@@ -62,13 +796,107 @@ class BLRequestHandler(socketserver.BaseRequestHandler):
         Subclasses must overwrite this method.
         """
 
-        if params:
-            self.send_text_response(cmd.upper() + ' ' + ' '.join([param.upper() for param in params]))
+        self.send_response(cmd.upper(), *[param.upper() for param in params])
+
+    def send_response(self, *fields):
+        """Send a response made of fields (str, int, float or None).
+        Fields are joined by a white space in the text protocol and typed in the binary protocol.
+        """
+
+        if self.binary_protocol:
+            if str(fields[0]).startswith('ERROR'):
+                STATS.mark_error()
+            self.send_buffers(pack_message(MESSAGE_RESPONSE, pack_fields(fields)))
         else:
-            self.send_text_response(cmd.upper())
+            self.send_text_response(' '.join(str(field) for field in fields))
 
     def send_text_response(self, response):
-        self.request.sendall((response + '\n').encode('ascii'))
+        """Send a response given as text. Replies carrying names, paths or other strings
+        that may look like numbers or contain spaces should use `send_response` instead.
+        """
+
+        if self.binary_protocol:
+            # the first line is split into typed fields; further lines are sent as strings.
+            lines = response.split('\n')
+            self.send_response(*([typed_word(word) for word in lines[0].split(' ')] + lines[1:]))
+            return
+
+        if response.startswith('ERROR'):
+            STATS.mark_error()
+        self.send_buffers([(response + '\n').encode('ascii')])
+
+    def send_binary_response(self, response, data, typecode='B', shape=None):
+        """Send a text header line followed by binary data.
+        `data` may be any object supporting the buffer protocol; it is sent without being copied.
+
+        In the binary protocol, the header words and the data are sent in one message,
+        the data as an array of `typecode` (a struct/array type code) and `shape`.
+        """
+
+        if self.binary_protocol:
+            fields = [typed_word(word) for word in response.split(' ')]
+            self.send_buffers(pack_message(MESSAGE_RESPONSE, pack_fields(fields, data, typecode, shape)))
+            return
+
+        self.send_buffers([(response + '\n').encode('ascii'), data])
+
+    def send_buffers(self, buffers):
+        """Queue buffers for the client. They are written at once unless a burst
+        of statements is being processed (see `handle`) and `output_limit` is not reached.
+        """
+
+        with self.send_lock:
+            views = [memoryview(buffer).cast('B') for buffer in buffers]
+            self.output_bytes += sum(view.nbytes for view in views)
+            if not self.corked or self.output_bytes >= self.output_limit:
+                self.output.extend(views)
+                self.flush_output()
+            else:
+                # keep copies; the caller may reuse its buffers (e.g., a FrameBuffer) once this returns.
+                self.output.extend(memoryview(view.tobytes()) for view in views)
+
+    def flush_output(self):
+        """Write the queued buffers, with one `sendmsg` call if possible."""
+
+        with self.send_lock:
+            if not self.output:
+                return
+            buffers, nbytes = self.output, self.output_bytes
+            self.output, self.output_bytes = [], 0
+            start = clock()
+            if hasattr(self.request, 'sendmsg'):
+                send_scattered(self.request, buffers)
+            elif len(buffers) == 1 or nbytes > self.output_limit:
+                for buffer in buffers:
+                    self.request.sendall(buffer)
+            else:
+                self.request.sendall(b''.join(buffers))
+            seconds = clock() - start
+        # the send belongs to the running command (if any) and to the finished commands of the burst.
+        STATS.add_phase('send', start, seconds)
+        STATS.commands_sent(start, seconds)
+        STATS.add_sent(nbytes)
+
+
+# upper bound of the buffers passed to one sendmsg call (IOV_MAX is 1024 on Linux).
+SENDMSG_MAX_BUFFERS = 512
+
+
+def send_scattered(sock, buffers):
+    """Send all buffers (memoryviews of bytes) with as few `sendmsg` calls as possible."""
+
+    buffers = [buffer for buffer in buffers if buffer.nbytes]
+    index = 0
+    while index < len(buffers):
+        sent = sock.sendmsg(buffers[index:index + SENDMSG_MAX_BUFFERS])
+        # skip what was sent; a partially sent buffer is resumed from its remainder.
+        while sent:
+            if sent >= buffers[index].nbytes:
+                sent -= buffers[index].nbytes
+                index += 1
+            else:
+                buffers[index] = buffers[index][sent:]
+                sent = 0
 
 
 def shutdown_server(server):
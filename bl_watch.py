@@ -0,0 +1,133 @@
+"""Notification of files completed in a directory.
+
+`DirectoryWatcher` calls a callback with the path of every file that is
+completely written into a directory after the watcher starts:
+
+* On Linux, inotify reports IN_CLOSE_WRITE and IN_MOVED_TO events.
+* Elsewhere (or when inotify is unavailable, e.g., on network shares),
+  the directory is polled and a file is regarded as complete when its size
+  and modification time stay unchanged between two polls.
+"""
+
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
+import struct
+import threading
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT = struct.Struct('=iIII')
+
+
+def _load_libc():
+    if not hasattr(os, 'uname') or os.uname()[0] != 'Linux':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class DirectoryWatcher(object):
+    """Watch a directory in a background thread and report completed files."""
+
+    def __init__(self, directory, callback, pattern='*', poll_interval=0.2, use_inotify=True):
+        self.directory = directory
+        self.callback = callback
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.method = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        fd = self._open_inotify() if self.use_inotify else None
+        if fd is not None:
+            self.method = 'inotify'
+            target, args = self._run_inotify, (fd,)
+        else:
+            self.method = 'poll'
+            target, args = self._run_poll, (self._snapshot(),)
+
+        self.thread = threading.Thread(target=target, args=args)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, wait=True):
+        self.stopped.set()
+        if wait and self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def _notify(self, name):
+        if fnmatch.fnmatch(name, self.pattern):
+            try:
+                self.callback(os.path.join(self.directory, name))
+            except Exception as e:
+                print('Failed to process {}: {}'.format(name, e))
+
+    def _open_inotify(self):
+        libc = _load_libc()
+        if libc is None:
+            return None
+        fd = libc.inotify_init()
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(self.directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def _run_inotify(self, fd):
+        try:
+            while not self.stopped.is_set():
+                readable, _, _ = select.select([fd], [], [], self.poll_interval)
+                if not readable:
+                    continue
+                buffer = os.read(fd, 65536)
+                offset = 0
+                while offset < len(buffer):
+                    _, mask, _, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+                    offset += INOTIFY_EVENT.size
+                    name = buffer[offset:offset + length].rstrip(b'\0')
+                    offset += length
+                    if mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and name:
+                        self._notify(os.fsdecode(name))
+        finally:
+            os.close(fd)
+
+    def _snapshot(self):
+        """Return a dict of file name to (size, mtime) for the files in the directory."""
+
+        snapshot = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return snapshot
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            snapshot[name] = (stat.st_size, stat.st_mtime)
+        return snapshot
+
+    def _run_poll(self, known):
+        # files that exist when the watcher starts are not reported unless they are rewritten.
+        reported = dict(known)
+        previous = known
+        while not self.stopped.wait(self.poll_interval):
+            current = self._snapshot()
+            for name in sorted(current):
+                state = current[name]
+                if state[0] > 0 and previous.get(name) == state and reported.get(name) != state:
+                    reported[name] = state
+                    self._notify(name)
+            previous = current
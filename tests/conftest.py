@@ -0,0 +1,34 @@
+import os
+import socketserver
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bl_sim
+
+
+def serve(handler_class):
+    """Start a threaded TCP server on a free local port. Return the server."""
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), handler_class)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+@pytest.fixture
+def tpx3_server(tmp_path):
+    """A TPX3 server on a small simulated device. Yield its address."""
+
+    device = bl_sim.SimulatedTpx3(width=64, height=48, occupancy=0.05)
+    namespace = bl_sim.load_tpx3_server(bl_sim.SimulatedPixet([device]))
+    namespace['DATA_DIR'] = str(tmp_path)
+    server = serve(namespace['TPX3RequestHandler'])
+    yield server.server_address
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,47 @@
+import time
+
+import numpy as np
+import pytest
+
+from bl_cbf import CbfImage, decode_byte_offset, encode_byte_offset, write_cbf
+
+# sequences whose encodings are long chains of 0x80 bytes.
+ADVERSARIAL = {
+    'ramp128': np.arange(20000, dtype=np.int32) * 128,
+    'alternating128': np.tile(np.array([0, 128], dtype=np.int32), 10000),
+    'alternating32640': np.tile(np.array([0, 32640], dtype=np.int32), 16000),
+}
+
+
+@pytest.mark.parametrize('values', [
+    np.zeros(100, dtype=np.int32),
+    np.array([0, 127, -127, 128, -128, 32767, -32767, 32768, -32768, 2 ** 31 - 1, -2 ** 31, 0], dtype=np.int32),
+    np.random.RandomState(0).randint(-2 ** 31, 2 ** 31, 5000).astype(np.int32),
+    np.random.RandomState(1).poisson(3, 5000).astype(np.int32),
+] + list(ADVERSARIAL.values()), ids=['zeros', 'limits', 'random', 'counts'] + list(ADVERSARIAL))
+def test_byte_offset_round_trip(values):
+    encoded = encode_byte_offset(values)
+    assert np.array_equal(decode_byte_offset(encoded, len(values)), values)
+
+
+@pytest.mark.parametrize('name', list(ADVERSARIAL))
+def test_byte_offset_marker_chains_decode_in_linear_time(name):
+    encoded = encode_byte_offset(ADVERSARIAL[name])
+    start = time.perf_counter()
+    decode_byte_offset(encoded, len(ADVERSARIAL[name]))
+    assert time.perf_counter() - start < 1.0
+
+
+def test_decode_rejects_truncated_buffer():
+    encoded = encode_byte_offset(np.array([1, 100000, 2], dtype=np.int32))
+    with pytest.raises(ValueError):
+        decode_byte_offset(encoded[:-2], 3)
+
+
+def test_cbf_file_round_trip(tmp_path):
+    data = np.random.RandomState(2).poisson(5, (48, 64)).astype(np.int32)
+    path = str(tmp_path / 'frame.cbf')
+    write_cbf(path, data, '# Exposure_time 0.1 s')
+    image = CbfImage.read(path)
+    assert np.array_equal(image.array, data)
+    assert '# Exposure_time 0.1 s' in image.header['contents']
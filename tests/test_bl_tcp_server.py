@@ -0,0 +1,66 @@
+import socket
+
+import numpy as np
+
+from bl_tcp_client import BLClient
+from bl_tcp_server import (BLRequestHandler, LineReader, MESSAGE_HEADER, MESSAGE_RESPONSE,
+                           pack_fields, pack_message, unpack_fields)
+from conftest import serve
+
+
+def test_fields_round_trip():
+    data = np.arange(6, dtype=np.int16).reshape(2, 3)
+    fields = ['OK', 3, -2.5, None, '000123']
+    buffers = pack_message(MESSAGE_RESPONSE, pack_fields(fields, data, 'h', data.shape))
+    message = b''.join(bytes(buffer) for buffer in buffers)
+
+    magic, kind, _, length = MESSAGE_HEADER.unpack_from(message)
+    assert (magic, kind, length) == (b'BL', MESSAGE_RESPONSE, len(message) - MESSAGE_HEADER.size)
+
+    decoded = unpack_fields(message[MESSAGE_HEADER.size:])
+    assert decoded[:-1] == fields
+    typecode, _, shape, view = decoded[-1]
+    assert (typecode, shape) == ('h', (2, 3))
+    assert np.array_equal(np.frombuffer(view, np.int16).reshape(shape), data)
+
+
+def test_line_reader_waits_for_complete_message():
+    message = b''.join(bytes(buffer) for buffer in pack_message(MESSAGE_RESPONSE, pack_fields(['OK', 1])))
+    left, right = socket.socketpair()
+    with left, right:
+        reader = LineReader(right)
+        left.sendall(message[:-3])
+        reader.fill()
+        assert reader.pop_message() is None
+        left.sendall(message[-3:] + message)
+        reader.fill()
+        assert unpack_fields(reader.pop_message()) == ['OK', 1]
+        assert unpack_fields(reader.pop_message()) == ['OK', 1]
+        assert reader.pop_message() is None
+
+
+def test_unterminated_last_line_is_processed_at_eof():
+    server = serve(BLRequestHandler)
+    try:
+        with socket.create_connection(server.server_address, timeout=5) as sock:
+            sock.sendall(b'a 1\nb 2')
+            sock.shutdown(socket.SHUT_WR)
+            received = b''
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                received += chunk
+        assert received == b'A 1\nB 2\n'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_binary_protocol_matches_text_protocol(tpx3_server):
+    with BLClient(*tpx3_server, timeout=5) as text, BLClient(*tpx3_server, timeout=5, binary=True) as binary:
+        for command in ['IS_CONNECTED', 'IS_RUNNING', 'INFO', 'MKDIR 000123']:
+            text_response = text.command(command)
+            binary_response = binary.command(command)
+            assert binary_response.text == text_response.text
+            assert binary_response.fields is not None
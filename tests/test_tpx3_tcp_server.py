@@ -0,0 +1,40 @@
+import time
+
+import numpy as np
+
+from bl_tcp_client import BLClient
+
+
+def test_last_frame_encodings_match_dense(tpx3_server):
+    with BLClient(*tpx3_server, timeout=5) as client:
+        assert client.command('ACQUIRE 1 0.01').ok
+        dense = client.last_frame()
+        assert dense.shape == (48, 64)
+        assert dense.any()
+        for encoding in ['SPARSE', 'ZLIB']:
+            assert np.array_equal(client.last_frame(encoding), dense)
+        assert not client.command('LAST_FRAME RLE').ok
+
+
+def test_abort_cancels_running_and_queued_jobs(tpx3_server):
+    with BLClient(*tpx3_server, timeout=5) as client:
+        start = time.perf_counter()
+        job_ids = [client.command('ACQUIRE_NOWAIT 1 1.0').words[2] for _ in range(3)]
+        assert job_ids == ['1', '2', '3']
+        time.sleep(0.1)
+        assert client.command('ABORT').ok
+        for job_id in job_ids:
+            assert client.command('JOB_WAIT {}'.format(job_id)).words[2:] == [job_id, 'CANCELLED', '-1']
+        assert time.perf_counter() - start < 1.0
+        assert client.command('IS_RUNNING').words[2] == '0'
+        assert client.command('JOBS').words[2:] == []
+
+
+def test_job_cancel_leaves_next_job_running(tpx3_server):
+    with BLClient(*tpx3_server, timeout=5) as client:
+        first = client.command('ACQUIRE_NOWAIT 1 1.0').words[2]
+        second = client.command('ACQUIRE_NOWAIT 1 0.05').words[2]
+        time.sleep(0.1)
+        assert client.command('JOB_CANCEL {}'.format(first)).ok
+        assert client.command('JOB_WAIT {}'.format(first)).words[3] == 'CANCELLED'
+        assert client.command('JOB_WAIT {} 5'.format(second)).words[3:] == ['DONE', '0']
@@ -1,158 +1,1320 @@
 """TCP server that controls an Advacam TimePIX3 device in compliance
 with a message from SPEC software.
 
+Every TPX3 device attached to Pixet Pro is served, the n-th one (from 0)
+on PORT + n. Each device has its own lock, frame ring buffer, subscribers,
+stack writer and acquisition thread, so acquisitions on different devices
+run in parallel.
+
 The following commands are available:
 
+* DEVICE [index|name] : "OK device index name count" for the device of this connection,
+  or select another device for the rest of the connection
 * IS_CONNECTED
 * RECONNECT
 * INFO
 * CONFIG
+  IS_CONNECTED and INFO are answered from the state cached when the server starts and after
+  RECONNECT, CONFIG and a failed acquisition, unless STATE_CACHE is disabled.
+* STATE : "OK state version connected running"; version counts the changes of the state
+* WAIT [IDLE|version] [timeout] : wait until no acquisition is queued or running (IDLE),
+  or until the state version exceeds the given one (default: the current one), then reply
+  "OK wait version connected running" (also when the timeout in seconds elapses)
+* NOTIFY ON|OFF : push "OK state_change version connected running" to this connection
+  whenever the state changes
 * ACQUIRE acq_count acq_time [filename]
-* ACQUIRE_NOWAIT acq_count acq_time [filename]
-* IS_RUNNING
-* ABORT
-* LAST_FRAME
+* ACQUIRE_NOWAIT acq_count acq_time [filename] : queue an acquisition and return its job ID
+* JOB_STATUS job_id : "OK job_status job_id state errno"
+* JOB_WAIT job_id [timeout] : wait until the job finishes (or the timeout in seconds elapses)
+* JOB_CANCEL job_id : remove a queued job or abort a running one
+* JOBS : list IDs of queued and running jobs
+* IS_RUNNING : 1 while an acquisition of this server is queued or running
+  (with STATE_CACHE; otherwise the device is asked whether it is acquiring)
+* ABORT : cancel the queued acquisitions and abort the running one
+* LAST_FRAME [DENSE|SPARSE|ZLIB] : "OK last_frame int16 size width height byteorder" followed by binary data.
+  SPARSE (requires NumPy) replies "OK last_frame_sparse int16 count width height byteorder size"
+  followed by the uint32 indices and then the int16 values of the count non-zero pixels;
+  ZLIB replies "OK last_frame_zlib int16 nbytes width height byteorder size"
+  followed by nbytes of the zlib-compressed int16 values (size: number of pixels)
+* GET_FRAME [first [last]] : frames first..last (default: the newest) from the ring buffer as
+  "OK get_frame int16 size width height byteorder first count" followed by binary data of count frames
+* FRAME_RANGE : "OK frame_range first last", sequence numbers of the frames in the ring buffer
+* ROI_SUM left top width height [left top width height ...] : "OK roi_sum sequence sum..."
+* PROJECTION X|Y [left top width height] : sums over columns (X) or rows (Y) of the frame or an ROI,
+  "OK projection int64 size byteorder axis sequence" followed by binary data
+* HISTOGRAM bins [min max] : intensity histogram of the frame (default range: from the lowest
+  value, or 0 if none is negative, to the highest value + 1),
+  "OK histogram int64 size byteorder min max sequence" followed by binary data
+* BIN n : frame binned by n x n pixels (cropped to a multiple of n),
+  "OK binned int32 size width height byteorder sequence" followed by binary data
+  The reduction commands (ROI_SUM, PROJECTION, HISTOGRAM, BIN) work on the newest frame
+  in the ring buffer with NumPy, which must be available to the Python of Pixet Pro.
+  While a dark or flat correction is set, they work on the corrected frame and
+  PROJECTION and BIN send float64 and float32 sums.
+* DARK [filename|ACCUMULATED|OFF] : set the dark frame from a .npy file in DATA_DIR or the
+  accumulated mean, or remove it; "OK dark source" ("off" if none)
+* FLAT [filename|ACCUMULATED|OFF] : set the flat field likewise; "OK flat source"
+* ACCUMULATE [START|STOP|RESET] : add every frame acquired while started, after correction,
+  to a running sum, mean and variance; "OK accumulate on|off count"
+* ACCUMULATED [SUM|MEAN|VARIANCE] : "OK accumulated float64 size width height byteorder kind count"
+  followed by binary data (default: MEAN)
+* CORRECTED_FRAME : "OK corrected_frame float32 size width height byteorder sequence"
+  followed by the newest frame in the ring buffer after the dark and flat correction
+* SUBSCRIBE [every_n [DROP|BLOCK [queue_length]]] : push every n-th acquired frame
+  to this connection as "OK last_frame int16 size width height byteorder sequence" + binary data;
+  a dropped frame can be fetched by its sequence number with GET_FRAME
+* UNSUBSCRIBE
+* WRITER_OPEN filename : append every frame acquired from now on to DATA_DIR/filename,
+  a .npy stack written by a background thread (use ACQUIRE without a filename meanwhile)
+* WRITER_CLOSE : "OK writer_close path frames" after all queued frames are written
+* WRITER_STATUS : "OK writer_status path frames queued errors"
 * MKDIR dirpath
 * KILL : close both Pixet Pro and this server
+* TRACE [n | RESET | FILE name | FILE OFF] : phases of the last n commands as JSON lines,
+  also appended to a file in TRACE_DIR with FILE (implemented by the parent class). The trace of ACQUIRE includes the phases run by the
+  acquisition thread: queued, doSimpleAcquisition[_file] or doSimpleIntegralAcquisition,
+  lastAcqFrameRefInc, subFrameData, publish, writer_queue and accumulate.
+* PROTOCOL [TEXT|BINARY] : switch to length-prefixed binary messages (implemented by the parent class)
 * QUIT : close this server. (implemented by the parent class)
 
 tcp_server_example.py in Pixet Pro sample script was used as a reference.
 """
 
 import socketserver
-from threading import Thread
+from threading import Thread, Lock, Condition, Event
+from collections import deque
 # from bl_tcp_server import BLRequestHandler
 
 import sys
 import os
 import os.path
-import array
+import struct
+import time
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 PORT = 59876
 DATA_DIR = 'D:\\PIXet Pro'
 
+# Port to export STATS in the Prometheus text format (None: disabled).
+METRICS_PORT = None
+
+# JSON-lines file to which the trace of every command is appended (None: disabled).
+TRACE_FILE = None
+# Directory in which clients may start a trace file with TRACE FILE (None: not allowed).
+TRACE_DIR = None
+
+# Serve clients from one asyncio event loop (see bl_async_server.py)
+# instead of starting one thread per client.
+USE_ASYNCIO = False
+ASYNC_MAX_WORKERS = 4
+
+# Number of acquired frames kept for GET_FRAME.
+FRAME_RING_SIZE = 32
+
+# Frames queued for the writer thread before an acquisition waits for the disk,
+# and how often (in frames or seconds) a stack file is synced to disk.
+WRITER_QUEUE_LENGTH = 64
+WRITER_SYNC_FRAMES = 16
+WRITER_SYNC_INTERVAL = 1.0
+
+# zlib level of LAST_FRAME ZLIB (1: fastest).
+ZLIB_LEVEL = 1
+
+# Answer IS_CONNECTED, IS_RUNNING and INFO from the state kept by the server (see `DeviceState`)
+# instead of querying the device. Disable it if acquisitions are also started outside this server.
+STATE_CACHE = True
+
+
+class FrameBuffer(object):
+    """Reusable buffer through which a subframe is sent to a client.
+
+    If the subframe data exposes the buffer protocol, it is sent as is.
+    Otherwise (Pixet returns a list), the values are packed into a
+    preallocated bytearray, which is reused while the frame size is unchanged.
+    """
+
+    def __init__(self, typecode='h'):
+        self.typecode = typecode
+        self.buffer = bytearray()
+        self.packer = None
+
+    def load(self, subframe):
+        """Return a memoryview of the subframe data."""
+
+        data = subframe.data()
+        try:
+            return memoryview(data).cast('B')
+        except TypeError:
+            pass
+
+        size = subframe.size()
+        if self.packer is None or self.packer.size != size * struct.calcsize(self.typecode):
+            self.packer = struct.Struct('={}{}'.format(size, self.typecode))
+            self.buffer = bytearray(self.packer.size)
+        self.packer.pack_into(self.buffer, 0, *data)
+        return memoryview(self.buffer)
+
+
+class FrameRing(object):
+    """The last `capacity` acquired frames in one preallocated buffer.
+
+    Every frame is copied into its slot once, when it is acquired, and is
+    identified by a sequence number counting from 1. Readers copy a range of
+    consecutive frames out in one piece, so a client that falls behind can
+    catch up as long as its frames have not been overwritten.
+    The buffer is reallocated (and emptied) when the frame size changes.
+    """
+
+    def __init__(self, capacity=16):
+        self.capacity = capacity
+        self.lock = Lock()
+        self.buffer = bytearray()
+        self.frame_size = 0
+        self.shape = None
+        self.sequence = 0
+        self.stored = 0
+
+    def store(self, data, shape):
+        """Copy a frame (a bytes-like object) into the next slot and return its sequence number."""
+
+        with self.lock:
+            if len(data) != self.frame_size or shape != self.shape:
+                self.frame_size = len(data)
+                self.shape = shape
+                self.buffer = bytearray(self.frame_size * self.capacity)
+                self.stored = 0
+            self.sequence += 1
+            offset = (self.sequence % self.capacity) * self.frame_size
+            self.buffer[offset:offset + self.frame_size] = data
+            self.stored = min(self.stored + 1, self.capacity)
+            return self.sequence
+
+    def range(self):
+        """Return the sequence numbers of the oldest and newest frames held, or None if empty."""
+
+        with self.lock:
+            if not self.stored:
+                return None
+            return self.sequence - self.stored + 1, self.sequence
+
+    def get(self, first=None, last=None):
+        """Return (first, count, shape, data) of the frames first..last that are still held.
+
+        The range is clipped to the frames available; None is returned if none of them is.
+        `data` is a copy of the frames in sequence order.
+        """
+
+        with self.lock:
+            if not self.stored:
+                return None
+            oldest = self.sequence - self.stored + 1
+            if first is None:
+                first = self.sequence
+            if last is None:
+                last = first
+            first = max(first, oldest)
+            last = min(last, self.sequence)
+            if first > last:
+                return None
+
+            count = last - first + 1
+            start = (first % self.capacity) * self.frame_size
+            end = start + count * self.frame_size
+            view = memoryview(self.buffer)
+            if end <= len(self.buffer):
+                data = view[start:end].tobytes()
+            else:
+                # the range wraps around the end of the buffer.
+                data = view[start:].tobytes() + view[:end - len(self.buffer)].tobytes()
+            return first, count, self.shape, data
+
+
+class FrameSubscriber(object):
+    """A connection subscribed to acquired frames.
+
+    Frames are held in a bounded queue and sent from a dedicated thread, so that
+    a slow client does not delay the acquisition unless it asked for BLOCK.
+    """
+
+    def __init__(self, handler, every=1, policy='DROP', maxlen=4):
+        self.handler = handler
+        self.every = every
+        self.policy = policy
+        self.maxlen = maxlen
+        self.offered = 0
+        self.dropped = 0
+        self.closed = False
+        self.queue = deque()
+        self.condition = Condition()
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def offer(self, frame):
+        """Queue a frame, a tuple of (sequence, header, data, shape), unless it is decimated."""
+
+        self.offered += 1
+        if (self.offered - 1) % self.every:
+            return
+
+        with self.condition:
+            if self.policy == 'BLOCK':
+                while len(self.queue) >= self.maxlen and not self.closed:
+                    self.condition.wait()
+            elif len(self.queue) >= self.maxlen:
+                self.queue.popleft()
+                self.dropped += 1
+            if not self.closed:
+                self.queue.append(frame)
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                sequence, header, data, shape = self.queue.popleft()
+                self.condition.notify_all()
+            try:
+                self.handler.send_binary_response('{} {}'.format(header, sequence), data, 'h', shape)
+            except (OSError, IOError):
+                self.close()
+
+
+class FrameStream(object):
+    """Distributes each acquired frame to subscribed connections."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.subscribers = {}
+
+    def subscribe(self, handler, every=1, policy='DROP', maxlen=4):
+        self.unsubscribe(handler)
+        with self.lock:
+            self.subscribers[handler] = FrameSubscriber(handler, every, policy, maxlen)
+
+    def unsubscribe(self, handler):
+        with self.lock:
+            subscriber = self.subscribers.pop(handler, None)
+        if subscriber is not None:
+            subscriber.close()
+        return subscriber is not None
+
+    def publish(self, sequence, data, shape):
+        """Copy a frame once and queue it for every subscriber."""
+
+        with self.lock:
+            subscribers = list(self.subscribers.values())
+        if not subscribers:
+            return
+
+        height, width = shape
+        header = 'OK last_frame int16 {} {} {} {}'.format(width * height, width, height, sys.byteorder)
+        data = bytes(data)
+        for subscriber in subscribers:
+            subscriber.offer((sequence, header, data, shape))
+
+
+class DirectoryCache(object):
+    """Creates data directories, remembering those already created
+    so that the data drive is not queried for every acquisition."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.created = set()
+
+    def makedirs(self, dirname):
+        with self.lock:
+            if dirname in self.created:
+                return
+        with STATS.phase('mkdir'):
+            os.makedirs(dirname, exist_ok=True)
+        with self.lock:
+            self.created.add(dirname)
+
+    def forget(self, dirname):
+        """Forget a directory, e.g., after a failed write, so that it is created again if removed."""
+
+        with self.lock:
+            self.created.discard(dirname)
+
+
+class NpyStack(object):
+    """A .npy file of int16 frames to which frames are appended.
+
+    The header is written with room for any frame count and rewritten on every
+    sync, so that the file can be read with numpy.load(path, mmap_mode='r')
+    while the scan is still running.
+    """
+
+    HEADER_SIZE = 128
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.shape = None
+        self.frames = 0
+        self.synced_frames = 0
+        self.synced_time = time.time()
+        self.write_header()
+
+    def write_header(self):
+        shape = (self.frames,) + (self.shape or (0, 0))
+        descr = '<i2' if sys.byteorder == 'little' else '>i2'
+        text = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(descr, shape)
+        text = text.ljust(self.HEADER_SIZE - 11) + '\n'
+        self.file.seek(0)
+        self.file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(text)) + text.encode('latin1'))
+        self.file.seek(0, os.SEEK_END)
+
+    def append(self, data, shape):
+        if self.shape is None:
+            self.shape = shape
+        elif shape != self.shape:
+            raise ValueError('frame shape {} differs from {}'.format(shape, self.shape))
+        self.file.write(data)
+        self.frames += 1
+
+    def sync(self):
+        self.write_header()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.synced_frames = self.frames
+        self.synced_time = time.time()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+class FrameWriter(object):
+    """Writes captured frames into a `NpyStack` on a dedicated thread.
+
+    Frames are held in a bounded queue; when the disk falls behind by
+    `queue_length` frames, `offer` waits. The file is synced every
+    `sync_frames` frames or `sync_interval` seconds instead of every frame.
+    """
+
+    def __init__(self, queue_length=64, sync_frames=16, sync_interval=1.0):
+        self.queue_length = queue_length
+        self.sync_frames = sync_frames
+        self.sync_interval = sync_interval
+        self.condition = Condition()
+        self.queue = deque()
+        self.stack = None
+        self.errors = 0
+        self.thread = None
+
+    def open(self, path):
+        """Close the current stack, if any, and start a new one at `path`."""
+
+        self.close()
+        stack = NpyStack(path)
+        with self.condition:
+            self.stack = stack
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def close(self):
+        """Wait until the queued frames are written and close the stack. Return it, or None."""
+
+        with self.condition:
+            stack = self.stack
+            if stack is None:
+                return None
+            self.stack = None
+            closed = Event()
+            self.queue.append((stack, None, closed))
+            self.condition.notify_all()
+        closed.wait()
+        return stack
+
+    def status(self):
+        """Return (stack, queued frames, errors)."""
+
+        with self.condition:
+            return self.stack, len(self.queue), self.errors
+
+    def offer(self, data, shape):
+        """Queue a copy of a frame if a stack is open."""
+
+        with self.condition:
+            if self.stack is None:
+                return
+            while len(self.queue) >= self.queue_length:
+                self.condition.wait()
+            self.queue.append((self.stack, (bytes(data), shape), None))
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                stack, frame, closed = self.queue.popleft()
+                self.condition.notify_all()
+
+            try:
+                if closed is not None:
+                    stack.close()
+                else:
+                    stack.append(*frame)
+                    if (stack.frames - stack.synced_frames >= self.sync_frames
+                            or time.time() - stack.synced_time >= self.sync_interval):
+                        stack.sync()
+            except Exception as e:
+                print('Failed to write {}: {}'.format(stack.path, e))
+                with self.condition:
+                    self.errors += 1
+            finally:
+                if closed is not None:
+                    closed.set()
+
+
+DIRECTORIES = DirectoryCache()
+
+
+def encode_frame(data, width, height, encoding):
+    """Encode the int16 values of a frame for LAST_FRAME. Return (header, payload).
+
+    DENSE sends the values as they are. SPARSE sends the uint32 indices of the
+    non-zero pixels followed by their int16 values; ZLIB sends the compressed values.
+    The header states the encoding, the payload size and the decoded size.
+    """
+
+    size = width * height
+    if encoding == 'SPARSE':
+        values = numpy.frombuffer(data, dtype=numpy.int16)
+        indices = numpy.flatnonzero(values).astype(numpy.uint32)
+        payload = indices.tobytes() + values[indices].tobytes()
+        return 'OK last_frame_sparse int16 {} {} {} {} {}'.format(
+            indices.size, width, height, sys.byteorder, size), payload
+    if encoding == 'ZLIB':
+        payload = zlib.compress(data, ZLIB_LEVEL)
+        return 'OK last_frame_zlib int16 {} {} {} {} {}'.format(
+            len(payload), width, height, sys.byteorder, size), payload
+    return 'OK last_frame int16 {} {} {} {}'.format(size, width, height, sys.byteorder), data
+
+
+# struct type codes of the arrays sent by the reduction and accumulation commands.
+TYPECODES = {'int32': 'i', 'int64': 'q', 'float32': 'f', 'float64': 'd'}
+
+
+def roi_sums(image, rects):
+    """Return the sum of pixels in each rectangle (left, top, width, height), clipped to the image."""
+
+    dtype = numpy.int64 if image.dtype.kind in 'iu' else numpy.float64
+    return [image[max(top, 0):max(top + height, 0), max(left, 0):max(left + width, 0)].sum(dtype=dtype).item()
+            for left, top, width, height in rects]
+
+
+def project(image, axis, rect=None):
+    """Return the column sums (axis 'X') or row sums (axis 'Y') of the image or a rectangle in it.
+    The sums are int64 for an integer image and float64 for a corrected one."""
+
+    if rect is not None:
+        left, top, width, height = rect
+        image = image[max(top, 0):max(top + height, 0), max(left, 0):max(left + width, 0)]
+    dtype = numpy.int64 if image.dtype.kind in 'iu' else numpy.float64
+    return image.sum(axis=0 if axis == 'X' else 1, dtype=dtype)
+
+
+def bin_image(image, n):
+    """Return the sums of n x n pixel blocks; rows and columns beyond a multiple of n are dropped.
+    The sums are int32 for an integer image and float32 for a corrected one."""
+
+    height, width = image.shape[0] // n, image.shape[1] // n
+    blocks = image[:height * n, :width * n].reshape(height, n, width, n)
+    return blocks.sum(axis=(1, 3), dtype=numpy.int32 if image.dtype.kind in 'iu' else numpy.float32)
+
+
+class FrameCorrection(object):
+    """Dark-frame subtraction and flat-field normalization of frames.
+
+    The calibration arrays are loaded once and kept as float32; the flat field is
+    kept as a gain, mean(flat - dark) / (flat - dark), which is 0 where the flat
+    field has no counts. Setting a calibration replaces the arrays, so that a
+    frame being corrected in another thread keeps using consistent ones.
+    """
+
+    def __init__(self):
+        self.dark = None
+        self.flat = None
+        self.gain = None
+        self.dark_source = None
+        self.flat_source = None
+
+    @property
+    def active(self):
+        return self.dark is not None or self.gain is not None
+
+    def set_dark(self, array, source):
+        self.dark = None if array is None else numpy.array(array, dtype=numpy.float32)
+        self.dark_source = source
+        self._update_gain()
+
+    def set_flat(self, array, source):
+        self.flat = None if array is None else numpy.array(array, dtype=numpy.float32)
+        self.flat_source = source
+        self._update_gain()
+
+    def _update_gain(self):
+        if self.flat is None:
+            self.gain = None
+            return
+        signal = self.flat - self.dark if self.dark is not None else self.flat.copy()
+        valid = signal > 0
+        gain = numpy.zeros(signal.shape, dtype=numpy.float32)
+        if valid.any():
+            numpy.divide(signal[valid].mean(), signal, out=gain, where=valid)
+        self.gain = gain
+
+    def apply(self, image, out=None):
+        """Return the corrected float32 frame, written into `out` if it is given."""
+
+        dark, gain = self.dark, self.gain
+        if out is None:
+            out = numpy.empty(image.shape, dtype=numpy.float32)
+        numpy.copyto(out, image, casting='unsafe')
+        if dark is not None:
+            numpy.subtract(out, dark, out=out)
+        if gain is not None:
+            numpy.multiply(out, gain, out=out)
+        return out
+
+
+class FrameAccumulator(object):
+    """Running sum, mean and variance of the (corrected) frames acquired while enabled.
+
+    The arrays are allocated when the first frame arrives after a reset, and every
+    frame is added in place (Welford's algorithm for the mean and variance).
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.enabled = False
+        self.count = 0
+        self.shape = None
+
+    def start(self):
+        with self.lock:
+            self.enabled = True
+
+    def stop(self):
+        with self.lock:
+            self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+
+    def status(self):
+        with self.lock:
+            return self.enabled, self.count
+
+    def add(self, image, correction):
+        with self.lock:
+            if not self.enabled:
+                return
+            if self.count == 0 or self.shape != image.shape:
+                if self.shape != image.shape:
+                    self.shape = image.shape
+                    self.work = numpy.empty(image.shape, dtype=numpy.float32)
+                    self.sum, self.mean, self.m2, self.delta, self.temp = [
+                        numpy.empty(image.shape, dtype=numpy.float64) for _ in range(5)]
+                for array in (self.sum, self.mean, self.m2):
+                    array.fill(0)
+                self.count = 0
+
+            frame = correction.apply(image, self.work)
+            self.count += 1
+            numpy.add(self.sum, frame, out=self.sum)
+            numpy.subtract(frame, self.mean, out=self.delta)
+            numpy.divide(self.delta, self.count, out=self.temp)
+            numpy.add(self.mean, self.temp, out=self.mean)
+            numpy.subtract(frame, self.mean, out=self.temp)
+            numpy.multiply(self.temp, self.delta, out=self.temp)
+            numpy.add(self.m2, self.temp, out=self.m2)
+
+    def result(self, kind):
+        """Return (count, float64 array) of SUM, MEAN or VARIANCE (sample variance), or None if empty."""
+
+        with self.lock:
+            if self.count == 0:
+                return None
+            if kind == 'SUM':
+                return self.count, self.sum.copy()
+            if kind == 'MEAN':
+                return self.count, self.mean.copy()
+            return self.count, self.m2 / max(self.count - 1, 1)
+
+
+class AcquisitionJob(object):
+    """An acquisition submitted to `AcquisitionScheduler`."""
+
+    QUEUED = 'QUEUED'
+    RUNNING = 'RUNNING'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+    CANCELLED = 'CANCELLED'
+
+    def __init__(self, job_id, frames, acq_time, file_type, destfile):
+        self.job_id = job_id
+        self.frames = frames
+        self.acq_time = acq_time
+        self.file_type = file_type
+        self.destfile = destfile
+        self.state = AcquisitionJob.QUEUED
+        self.errno = -1
+        self.device_time = 0.0
+        self.submitted = clock()
+        self.phases = []
+        self.finished = Event()
+
+    def wait(self, timeout=None):
+        self.finished.wait(timeout)
+        return self.finished.is_set()
+
+
+class AcquisitionScheduler(object):
+    """Runs submitted acquisitions on a TPX3 device (a `DeviceContext`) one after another.
+
+    All acquisitions go through a single worker thread, which serializes
+    device access and lets the next exposure be queued while the current one
+    is running. Finished jobs are kept for status queries up to `history`.
+    """
+
+    def __init__(self, context, history=100):
+        self.context = context
+        self.history = history
+        self.condition = Condition()
+        self.queue = deque()
+        self.jobs = {}
+        self.finished_ids = deque()
+        self.current = None
+        self.last_id = 0
+        self.thread = None
+
+    def submit(self, frames, acq_time, file_type, destfile):
+        with self.condition:
+            self.last_id += 1
+            job = AcquisitionJob(self.last_id, frames, acq_time, file_type, destfile)
+            self.jobs[job.job_id] = job
+            self.queue.append(job)
+            self.context.state.update(running=True)
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify_all()
+        return job
+
+    def get(self, job_id):
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def pending(self):
+        """Return the running job (if any) followed by the queued jobs."""
+
+        with self.condition:
+            jobs = list(self.queue)
+            if self.current is not None:
+                jobs.insert(0, self.current)
+            return jobs
+
+    def cancel(self, job_id):
+        """Cancel a job. Return False if the job is unknown or has already finished."""
+
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.finished.is_set():
+                return False
+            if job.state == AcquisitionJob.QUEUED:
+                self.queue.remove(job)
+                self._finish(job, AcquisitionJob.CANCELLED, -1)
+                self.context.state.update(running=self.current is not None or bool(self.queue))
+                return True
+            job.state = AcquisitionJob.CANCELLED
+
+            # a running job is stopped by aborting the device operation. The worker cannot
+            # start the next job while the condition is held, so the abort cannot hit it.
+            if self.current is job:
+                self.context.device.abortOperation()
+            return True
+
+    def abort(self):
+        """Cancel all queued jobs and abort the device operation (the running job, if any).
+        Return the error code of `abortOperation`."""
+
+        with self.condition:
+            while self.queue:
+                self._finish(self.queue.popleft(), AcquisitionJob.CANCELLED, -1)
+            if self.current is not None:
+                self.current.state = AcquisitionJob.CANCELLED
+            errno = self.context.device.abortOperation()
+            self.context.state.update(running=self.current is not None)
+        return errno
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                job = self.queue.popleft()
+                job.state = AcquisitionJob.RUNNING
+                self.current = job
+
+            start = clock()
+            # the phases are added to the trace of the command waiting for the job.
+            with STATS.record_phases() as phases:
+                STATS.add_phase('queued', job.submitted, start - job.submitted)
+                try:
+                    errno = self.context.acquire(job.frames, job.acq_time, job.file_type, job.destfile)
+                except Exception as e:
+                    print('Acquisition job {} failed: {}'.format(job.job_id, e))
+                    errno = -1
+            job.device_time = clock() - start
+            job.phases = phases
+
+            with self.condition:
+                self.current = None
+                if job.state == AcquisitionJob.CANCELLED:
+                    self._finish(job, AcquisitionJob.CANCELLED, errno)
+                elif errno:
+                    self._finish(job, AcquisitionJob.FAILED, errno)
+                else:
+                    self._finish(job, AcquisitionJob.DONE, errno)
+                running = bool(self.queue)
+
+            # a failed acquisition may be due to a lost connection.
+            if errno:
+                self.context.state.refresh(info=False)
+            self.context.state.update(running=running)
+
+    def _finish(self, job, state, errno):
+        job.state = state
+        job.errno = errno
+        job.finished.set()
+
+        # forget the oldest finished jobs.
+        self.finished_ids.append(job.job_id)
+        while len(self.finished_ids) > self.history:
+            self.jobs.pop(self.finished_ids.popleft(), None)
+
+
+class DeviceState(object):
+    """Connection, run state and information of a device, kept so that queries
+    are answered from memory.
+
+    The state is refreshed when the server changes it (an acquisition is queued
+    or finishes, RECONNECT, CONFIG). `running` is true while an acquisition of
+    the server is queued or running. Every change increments `version` and wakes
+    up WAIT; connections that asked for NOTIFY get the new state pushed from a
+    dedicated thread, so that a slow client does not delay the acquisition.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.condition = Condition()
+        self.version = 0
+        self.connected = False
+        self.running = False
+        self.info = None
+        self.listeners = set()
+        self.changes = deque()
+        self.thread = None
+        self.refresh()
+
+    def refresh(self, info=True):
+        """Query the connection (and the device information) from the device."""
+
+        with STATS.device_call('isConnected'):
+            connected = bool(self.device.isConnected())
+        changes = {'connected': connected}
+        if info:
+            changes['info'] = (self.device.width(), self.device.height(), self.device.dataType(),
+                               self.device.fullName().replace(' ', '_'))
+        self.update(**changes)
+
+    def update(self, **changes):
+        with self.condition:
+            if all(getattr(self, name) == value for name, value in changes.items()):
+                return
+            for name, value in changes.items():
+                setattr(self, name, value)
+            self.version += 1
+            self.condition.notify_all()
+            if self.listeners:
+                self.changes.append(self._snapshot())
+
+    def snapshot(self):
+        """Return (version, connected, running)."""
+
+        with self.condition:
+            return self._snapshot()
+
+    def _snapshot(self):
+        return self.version, int(self.connected), int(self.running)
+
+    def wait(self, version=None, idle=False, timeout=None):
+        """Wait until the version exceeds `version` (default: the current one), or until
+        no acquisition is queued or running if `idle`. Return the state at that time or at the timeout."""
+
+        with self.condition:
+            if idle:
+                predicate = lambda: not self.running
+            else:
+                if version is None:
+                    version = self.version
+                predicate = lambda: self.version > version
+            deadline = None if timeout is None else clock() + timeout
+            while not predicate():
+                remaining = None if deadline is None else deadline - clock()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self._snapshot()
+
+    def listen(self, handler):
+        with self.condition:
+            self.listeners.add(handler)
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def unlisten(self, handler):
+        with self.condition:
+            self.listeners.discard(handler)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.changes:
+                    self.condition.wait()
+                state = self.changes.popleft()
+                listeners = list(self.listeners)
+            for handler in listeners:
+                try:
+                    handler.send_response('OK', 'state_change', *state)
+                except (OSError, IOError):
+                    self.unlisten(handler)
+
+
+class DeviceContext(object):
+    """A TPX3 device and what the server keeps for it: a frame ring buffer,
+    subscribers, a stack writer and an acquisition scheduler.
+
+    Every device has its own, so that acquisitions on different devices run in
+    parallel. `lock` serializes the calls handling frames of the device.
+    """
+
+    def __init__(self, device, index=0):
+        self.device = device
+        self.index = index
+        self.lock = Lock()
+        self.capture_buffer = FrameBuffer('h')
+        self.ring = FrameRing(FRAME_RING_SIZE)
+        self.stream = FrameStream()
+        self.writer = FrameWriter(WRITER_QUEUE_LENGTH, WRITER_SYNC_FRAMES, WRITER_SYNC_INTERVAL)
+        self.scheduler = AcquisitionScheduler(self)
+        self.correction = FrameCorrection()
+        self.accumulator = FrameAccumulator()
+        self.state = DeviceState(device)
+
+    def name(self):
+        return self.device.fullName().replace(' ', '_')
+
+    def acquire(self, frames, acq_time, file_type, destfile):
+        """Acquire a frame (frames == 0) or an integral of frames and capture the result."""
+
+        if frames == 0:
+            # Pixet writes the file within the call; name it separately to see the cost of file output.
+            with STATS.device_call('doSimpleAcquisition_file' if destfile else 'doSimpleAcquisition'):
+                errno = self.device.doSimpleAcquisition(1, acq_time, file_type, destfile)
+        else:
+            with STATS.device_call('doSimpleIntegralAcquisition'):
+                errno = self.device.doSimpleIntegralAcquisition(frames, acq_time, file_type, destfile)
+
+        if not errno:
+            self.capture_frame()
+        return errno
+
+    def capture_frame(self):
+        """Store the EVENT subframe of the last acquired frame in the ring buffer and publish it.
+
+        Return the sequence number of the frame, or None if there is no frame.
+        Called from the scheduler thread, which is the only user of `capture_buffer`.
+        """
+
+        with self.lock:
+            with STATS.device_call('lastAcqFrameRefInc'):
+                frame = self.device.lastAcqFrameRefInc()
+            if not frame:
+                return None
+
+        # `data` may point into the frame, which is therefore released only after its last use.
+        try:
+            with self.lock:
+                shape = (self.device.height(), self.device.width())
+                with STATS.device_call('subFrameData'):
+                    data = self.capture_buffer.load(frame.subFrames()[1])
+                sequence = self.ring.store(data, shape)
+
+            with STATS.phase('publish'):
+                self.stream.publish(sequence, data, shape)
+            with STATS.phase('writer_queue'):
+                self.writer.offer(data, shape)
+            if numpy is not None and self.accumulator.enabled:
+                with STATS.phase('accumulate'):
+                    self.accumulator.add(numpy.frombuffer(data, dtype=numpy.int16).reshape(shape), self.correction)
+        finally:
+            with self.lock:
+                frame.destroy()
+        return sequence
+
+    def newest_frame(self, corrected=True):
+        """Return (sequence, 2D array) of the newest frame in the ring buffer, or None.
+
+        The array is int16, or float32 if a dark or flat correction is set and `corrected` is true.
+        """
+
+        frames = self.ring.get()
+        if frames is None:
+            return None
+        sequence, _, shape, data = frames
+        image = numpy.frombuffer(data, dtype=numpy.int16).reshape(shape)
+        if corrected and self.correction.active:
+            image = self.correction.apply(image)
+        return sequence, image
+
+
+# contexts of the devices served, in the order of pixet.devicesTpx3().
+DEVICES = []
+
 
 class TPX3RequestHandler(BLRequestHandler):
-    """Concrete subclass of an abstract request handler."""
+    """Concrete subclass of an abstract request handler.
+
+    Commands act on `context`, the device served by the port (see `handler_class`),
+    which a connection may switch with DEVICE.
+    """
+
+    context = None
+    frame_buffer = None
+    blocking_commands = ('ACQUIRE', 'JOB_WAIT', 'WAIT')
 
     def process_command(self, cmd, params):
         """Processing command received from client
         """
 
-        global TPX3
-        # tpx3 = pixet.devicesTpx3()[0]
+        context = self.context
+        device = context.device
+        scheduler = context.scheduler
 
         cmd = cmd.upper()
 
-        if cmd == 'IS_CONNECTED':
-            self.send_text_response('OK is_connected {:d}'.format(TPX3.isConnected()))
+        if cmd == 'DEVICE':
+            if len(params) == 0:
+                self.send_response('OK', 'device', context.index, context.name(), len(DEVICES))
+            elif len(params) == 1:
+                selected = [c for c in DEVICES if params[0] in (str(c.index), c.name())]
+                if not selected:
+                    self.send_text_response('ERROR:108 unknown_device')
+                else:
+                    # subscriptions are per device.
+                    context.stream.unsubscribe(self)
+                    context.state.unlisten(self)
+                    self.context = selected[0]
+                    self.send_response('OK', 'device', self.context.index, self.context.name())
+            else:
+                self.send_text_response('ERROR:102 illegal_arguments')
+
+        elif cmd == 'IS_CONNECTED':
+            if STATE_CACHE:
+                self.send_response('OK', 'is_connected', int(context.state.connected))
+            else:
+                self.send_response('OK', 'is_connected', int(device.isConnected()))
 
         elif cmd == 'RECONNECT':
-            self.send_text_response('OK reconnect {:d}'.format(TPX3.reconnect()))
+            with context.lock:
+                errno = device.reconnect()
+            context.state.refresh()
+            self.send_response('OK', 'reconnect', int(errno))
 
         elif cmd == 'INFO':
-            # self.send_text_response('OK info {} {} {} \"{}\"'.format(TPX3.width(), TPX3.height(), TPX3.dataType(), TPX3.fullName()))
-            self.send_text_response('OK info {} {} {} {}'.format(TPX3.width(), TPX3.height(), TPX3.dataType(), TPX3.fullName().replace(' ', '_')))
+            # self.send_text_response('OK info {} {} {} \"{}\"'.format(device.width(), device.height(), device.dataType(), device.fullName()))
+            if STATE_CACHE:
+                self.send_response('OK', 'info', *context.state.info)
+            else:
+                self.send_response('OK', 'info', device.width(), device.height(), device.dataType(), device.fullName().replace(' ', '_'))
 
         elif cmd == 'CONFIG':
-            TPX3.setOperationMode(pixet.PX_TPX3_OPM_EVENT_ITOT)
+            with context.lock:
+                device.setOperationMode(pixet.PX_TPX3_OPM_EVENT_ITOT)
+            context.state.refresh()
             self.send_text_response('OK config')
 
+        elif cmd == 'STATE':
+            self.send_response('OK', 'state', *context.state.snapshot())
+
+        elif cmd == 'WAIT':
+            # WAIT [IDLE|version] [timeout]
+            idle = len(params) > 0 and params[0].upper() == 'IDLE'
+            if len(params) > 2:
+                self.send_text_response('ERROR:102 illegal_arguments')
+            else:
+                version = int(params[0]) if len(params) > 0 and not idle else None
+                timeout = float(params[1]) if len(params) > 1 else None
+                self.send_response('OK', 'wait', *context.state.wait(version, idle, timeout))
+
+        elif cmd == 'NOTIFY':
+            if len(params) == 1 and params[0].upper() in ('ON', 'OFF'):
+                if params[0].upper() == 'ON':
+                    # reply before the first change can be pushed.
+                    self.send_text_response('OK notify on')
+                    context.state.listen(self)
+                else:
+                    context.state.unlisten(self)
+                    self.send_text_response('OK notify off')
+            else:
+                self.send_text_response('ERROR:102 illegal_arguments')
+
         elif cmd == 'ACQUIRE':
             # This command waits until the acquisition is completed.
             if len(params) == 2:
                 # acquire data without file output
                 frames = int(params[0])
-                if frames == 0:
-                    errno = TPX3.doSimpleAcquisition(1, float(params[1]), pixet.PX_FTYPE_NONE, "")
-                else:
-                    errno = TPX3.doSimpleIntegralAcquisition(frames, float(params[1]), pixet.PX_FTYPE_NONE, "")
+                errno = self.acquire_wait(frames, float(params[1]), pixet.PX_FTYPE_NONE, "")
 
                 if errno:
-                    self.send_text_response('ERROR:{} acquire'.format(errno))
+                    self.send_response('ERROR:{}'.format(errno), 'acquire')
                 else:
                     self.send_text_response('OK acquire')
             elif len(params) == 3:
                 # acquire data with file output
                 # create a data folder if it does not exist
                 destfile = os.path.join(DATA_DIR, params[2])
-                if not os.path.exists(os.path.dirname(destfile)):
-                    os.makedirs(os.path.dirname(destfile))
+                DIRECTORIES.makedirs(os.path.dirname(destfile))
 
                 # pixet.PX_FTYPE_AUTODETECT, PX_FTYPE_PNG
                 frames = int(params[0])
                 if frames == 0:
-                    errno = TPX3.doSimpleAcquisition(1, float(params[1]), pixet.PX_FTYPE_AUTODETECT, destfile)
+                    errno = self.acquire_wait(frames, float(params[1]), pixet.PX_FTYPE_AUTODETECT, destfile)
                 else:
-                    errno = TPX3.doSimpleIntegralAcquisition(frames, float(params[1]), pixet.PX_FTYPE_NONE, "")
+                    errno = self.acquire_wait(frames, float(params[1]), pixet.PX_FTYPE_NONE, "")
 
                 if errno:
-                    self.send_text_response('ERROR:{} acquire'.format(errno))
+                    DIRECTORIES.forget(os.path.dirname(destfile))
+                    self.send_response('ERROR:{}'.format(errno), 'acquire')
                 else:
                     self.send_text_response('OK acquire')
             else:
                 self.send_text_response('ERROR:102 illegal_arguments')
         elif cmd == 'ACQUIRE_NOWAIT':
-            # This command does until the acquisition is completed.
+            # This command returns as soon as the acquisition is queued.
             if len(params) == 2:
                 # acquire data without file output
                 frames = int(params[0])
-                if frames == 0:
-                    Thread(target=TPX3.doSimpleAcquisition, args=(1, float(params[1]), pixet.PX_FTYPE_NONE, "")).start()
-                else:
-                    Thread(target=TPX3.doSimpleIntegralAcquisition, args=(frames, float(params[1]), pixet.PX_FTYPE_NONE, "")).start()
+                job = scheduler.submit(frames, float(params[1]), pixet.PX_FTYPE_NONE, "")
 
-                self.send_text_response('UNKNOWN acquire_nowait')
+                self.send_response('OK', 'acquire_nowait', job.job_id)
             elif len(params) == 3:
                 # acquire data with file output
 
                 # create a data folder if it does not exist
                 destfile = os.path.join(DATA_DIR, params[2])
-                if not os.path.exists(os.path.dirname(destfile)):
-                    os.makedirs(os.path.dirname(destfile))
+                DIRECTORIES.makedirs(os.path.dirname(destfile))
 
                 # pixet.PX_FTYPE_AUTODETECT
                 frames = int(params[0])
-                if frames == 0:
-                    Thread(target=TPX3.doSimpleAcquisition, args=(1, float(params[1]), pixet.PX_FTYPE_AUTODETECT, destfile)).start()
+                job = scheduler.submit(frames, float(params[1]), pixet.PX_FTYPE_AUTODETECT, destfile)
+
+                self.send_response('OK', 'acquire_nowait', job.job_id)
+            else:
+                self.send_text_response('ERROR:102 illegal_arguments')
+
+        elif cmd == 'JOB_STATUS' or cmd == 'JOB_WAIT':
+            if len(params) == 1 or (cmd == 'JOB_WAIT' and len(params) == 2):
+                job = scheduler.get(int(params[0]))
+                if job is None:
+                    self.send_text_response('ERROR:104 unknown_job')
                 else:
-                    Thread(target=TPX3.doSimpleIntegralAcquisition, args=(frames, float(params[1]), pixet.PX_FTYPE_AUTODETECT, destfile)).start()
+                    if cmd == 'JOB_WAIT':
+                        job.wait(float(params[1]) if len(params) == 2 else None)
+                    self.send_response('OK', cmd.lower(), job.job_id, job.state, job.errno)
+            else:
+                self.send_text_response('ERROR:102 illegal_arguments')
 
-                self.send_text_response('UNKNOWN acquire_nowait')
+        elif cmd == 'JOB_CANCEL':
+            if len(params) == 1:
+                if scheduler.cancel(int(params[0])):
+                    self.send_response('OK', 'job_cancel', int(params[0]))
+                else:
+                    self.send_text_response('ERROR:104 unknown_job')
             else:
                 self.send_text_response('ERROR:102 illegal_arguments')
 
+        elif cmd == 'JOBS':
+            self.send_response('OK', 'jobs', *[job.job_id for job in scheduler.pending()])
+
         elif cmd == 'IS_RUNNING':
-            self.send_text_response('OK is_running {:d}'.format(TPX3.isAcquisitionRunning()))
+            if STATE_CACHE:
+                is_running = context.state.running
+            else:
+                with STATS.device_call('isAcquisitionRunning'):
+                    is_running = device.isAcquisitionRunning()
+            self.send_response('OK', 'is_running', int(is_running))
 
         elif cmd == 'ABORT':
-            errno = TPX3.abortOperation()
+            errno = scheduler.abort()
             if errno:
-                self.send_text_response('ERROR:{} abort'.format(errno))
+                self.send_response('ERROR:{}'.format(errno), 'abort')
             else:
                 self.send_text_response('OK abort')
 
         elif cmd == 'LAST_FRAME':
-            frame = TPX3.lastAcqFrameRefInc()
+            encoding = params[0].upper() if params else 'DENSE'
+            if len(params) > 1 or encoding not in ('DENSE', 'SPARSE', 'ZLIB'):
+                self.send_text_response('ERROR:102 illegal_arguments')
+                return
+            if encoding == 'SPARSE' and numpy is None:
+                self.send_text_response('ERROR:106 numpy_unavailable')
+                return
+
+            with context.lock:
+                with STATS.device_call('lastAcqFrameRefInc'):
+                    frame = device.lastAcqFrameRefInc()
             if not frame:
                 self.send_text_response('ERROR:103 no_last_frame')
-            else:
-                # subframes[0]: iTOT, subframes[1]: EVENT.
-                subframes = frame.subFrames()
+                return
 
-                # send header text and binary data
-                self.send_text_response('OK last_frame int16 {}'.format(subframes[1].size()))
-                self.request.sendall(array.array('h', subframes[1].data()))
+            # the data may point into the frame; it is released after the data is sent.
+            try:
+                with context.lock:
+                    # subframes[0]: iTOT, subframes[1]: EVENT.
+                    subframes = frame.subFrames()
+                    if self.frame_buffer is None:
+                        self.frame_buffer = FrameBuffer('h')
+                    with STATS.device_call('subFrameData'):
+                        data = self.frame_buffer.load(subframes[1])
+                    width, height = device.width(), device.height()
 
+                if encoding == 'DENSE':
+                    # send header text and binary data.
+                    # header: dtype, number of elements, width, height and byte order.
+                    header, payload = encode_frame(data, width, height, encoding)
+                    self.send_binary_response(header, payload, 'h', (height, width))
+                else:
+                    with STATS.phase('encode'):
+                        header, payload = encode_frame(data, width, height, encoding)
+                    self.send_binary_response(header, payload)
+            finally:
                 # release the frame
-                frame.destroy()
+                with context.lock:
+                    frame.destroy()
                 # gc.collect()
 
+        elif cmd == 'GET_FRAME':
+            if len(params) <= 2:
+                first = int(params[0]) if len(params) > 0 else None
+                last = int(params[1]) if len(params) > 1 else None
+                frames = context.ring.get(first, last)
+                if frames is None:
+                    self.send_text_response('ERROR:105 frame_not_available')
+                else:
+                    first, count, (height, width), data = frames
+                    self.send_binary_response('OK get_frame int16 {} {} {} {} {} {}'.format(
+                        count * width * height, width, height, sys.byteorder, first, count),
+                        data, 'h', (count, height, width))
+            else:
+                self.send_text_response('ERROR:102 illegal_arguments')
+
+        elif cmd == 'FRAME_RANGE':
+            frame_range = context.ring.range()
+            if frame_range is None:
+                self.send_text_response('ERROR:105 frame_not_available')
+            else:
+                self.send_response('OK', 'frame_range', frame_range[0], frame_range[1])
+
+        elif cmd in ('ROI_SUM', 'PROJECTION', 'HISTOGRAM', 'BIN'):
+            self.process_reduction_command(cmd, params)
+
+        elif cmd in ('DARK', 'FLAT', 'ACCUMULATE', 'ACCUMULATED', 'CORRECTED_FRAME'):
+            if numpy is None:
+                self.send_text_response('ERROR:106 numpy_unavailable')
+            else:
+                self.process_correction_command(cmd, params)
+
+        elif cmd == 'SUBSCRIBE':
+            if len(params) <= 3:
+                every = int(params[0]) if len(params) > 0 else 1
+                policy = params[1].upper() if len(params) > 1 else 'DROP'
+                maxlen = int(params[2]) if len(params) > 2 else 4
+                if every < 1 or maxlen < 1 or policy not in ('DROP', 'BLOCK'):
+                    self.send_text_response('ERROR:102 illegal_arguments')
+                else:
+                    # reply before the first frame can be pushed.
+                    self.send_response('OK', 'subscribe', every, policy, maxlen)
+                    context.stream.subscribe(self, every, policy, maxlen)
+            else:
+                self.send_text_response('ERROR:102 illegal_arguments')
+
+        elif cmd == 'UNSUBSCRIBE':
+            context.stream.unsubscribe(self)
+            self.send_text_response('OK unsubscribe')
+
+        elif cmd == 'WRITER_OPEN':
+            if len(params) == 1:
+                path = os.path.join(DATA_DIR, params[0])
+                if not path.endswith('.npy'):
+                    path += '.npy'
+                try:
+                    DIRECTORIES.makedirs(os.path.dirname(path))
+                    context.writer.open(path)
+                except (IOError, OSError) as e:
+                    DIRECTORIES.forget(os.path.dirname(path))
+                    self.send_response('ERROR:{}'.format(e.errno or -1), 'writer_open', path)
+                    return
+                self.send_response('OK', 'writer_open', path)
+            else:
+                self.send_text_response('ERROR:102 illegal_arguments')
+
+        elif cmd == 'WRITER_CLOSE':
+            stack = context.writer.close()
+            if stack is None:
+                self.send_text_response('ERROR:107 writer_not_open')
+            else:
+                self.send_response('OK', 'writer_close', stack.path, stack.frames)
+
+        elif cmd == 'WRITER_STATUS':
+            stack, queued, errors = context.writer.status()
+            if stack is None:
+                self.send_text_response('ERROR:107 writer_not_open')
+            else:
+                self.send_response('OK', 'writer_status', stack.path, stack.frames, queued, errors)
+
         elif cmd == 'MKDIR':
             if len(params) == 1:
                 dirname = os.path.join(DATA_DIR, params[0])
-                os.makedirs(dirname, exist_ok=True)
-                self.send_text_response('OK mkdir {}'.format(dirname))
+                DIRECTORIES.forget(dirname)
+                DIRECTORIES.makedirs(dirname)
+                self.send_response('OK', 'mkdir', dirname)
             else:
                 self.send_text_response('ERROR:102 illegal_arguments')
 
@@ -165,22 +1327,184 @@ class TPX3RequestHandler(BLRequestHandler):
         else:
             self.send_text_response('ERROR:101 unknown_command')
 
+    def process_reduction_command(self, cmd, params):
+        """Reduce the newest frame in the ring buffer and send only the result."""
+
+        if numpy is None:
+            self.send_text_response('ERROR:106 numpy_unavailable')
+            return
+        frame = self.context.newest_frame()
+        if frame is None:
+            self.send_text_response('ERROR:105 frame_not_available')
+            return
+        sequence, image = frame
+
+        if cmd == 'ROI_SUM':
+            if params and len(params) % 4 == 0:
+                values = [int(param) for param in params]
+                rects = [values[i:i + 4] for i in range(0, len(values), 4)]
+                self.send_response('OK', 'roi_sum', sequence, *roi_sums(image, rects))
+            else:
+                self.send_text_response('ERROR:102 illegal_arguments')
+
+        elif cmd == 'PROJECTION':
+            if len(params) in (1, 5) and params[0].upper() in ('X', 'Y'):
+                axis = params[0].upper()
+                rect = [int(param) for param in params[1:]] if len(params) == 5 else None
+                result = project(image, axis, rect)
+                self.send_binary_response('OK projection {} {} {} {} {}'.format(
+                    result.dtype.name, result.size, sys.byteorder, axis.lower(), sequence),
+                    result, TYPECODES[result.dtype.name])
+            else:
+                self.send_text_response('ERROR:102 illegal_arguments')
+
+        elif cmd == 'HISTOGRAM':
+            try:
+                bins = int(params[0]) if len(params) in (1, 3) else 0
+                if len(params) == 3:
+                    low, high = float(params[1]), float(params[2])
+                else:
+                    # a corrected frame may have negative values.
+                    low = min(0, int(numpy.floor(numpy.nanmin(image))))
+                    high = int(numpy.floor(numpy.nanmax(image))) + 1
+            except ValueError:
+                bins = 0
+            if bins > 0 and low < high:
+                counts, _ = numpy.histogram(image, bins, (low, high))
+                counts = counts.astype(numpy.int64)
+                self.send_binary_response('OK histogram int64 {} {} {} {} {}'.format(
+                    bins, sys.byteorder, low, high, sequence), counts, 'q')
+            else:
+                self.send_text_response('ERROR:102 illegal_arguments')
+
+        elif cmd == 'BIN':
+            try:
+                factor = int(params[0]) if len(params) == 1 else 0
+            except ValueError:
+                factor = 0
+            if 0 < factor <= min(image.shape):
+                result = bin_image(image, factor)
+                height, width = result.shape
+                self.send_binary_response('OK binned {} {} {} {} {} {}'.format(
+                    result.dtype.name, result.size, width, height, sys.byteorder, sequence),
+                    result, TYPECODES[result.dtype.name], result.shape)
+            else:
+                self.send_text_response('ERROR:102 illegal_arguments')
+
+    def process_correction_command(self, cmd, params):
+        """Set dark/flat calibrations, control the accumulator and send corrected results."""
+
+        context = self.context
+        correction, accumulator = context.correction, context.accumulator
+
+        if cmd in ('DARK', 'FLAT'):
+            if len(params) > 1:
+                self.send_text_response('ERROR:102 illegal_arguments')
+                return
+            if len(params) == 1:
+                source = params[0]
+                if source.upper() == 'OFF':
+                    array, source = None, None
+                elif source.upper() == 'ACCUMULATED':
+                    result = accumulator.result('MEAN')
+                    if result is None:
+                        self.send_text_response('ERROR:110 no_accumulated_frames')
+                        return
+                    array, source = result[1], 'accumulated_{}'.format(result[0])
+                else:
+                    try:
+                        array = numpy.load(os.path.join(DATA_DIR, source))
+                    except (IOError, OSError, ValueError):
+                        self.send_response('ERROR:2', cmd.lower(), source)
+                        return
+                if array is not None and array.shape != (context.device.height(), context.device.width()):
+                    self.send_text_response('ERROR:109 shape_mismatch')
+                    return
+                if cmd == 'DARK':
+                    correction.set_dark(array, source)
+                else:
+                    correction.set_flat(array, source)
+            source = correction.dark_source if cmd == 'DARK' else correction.flat_source
+            self.send_response('OK', cmd.lower(), source if source is not None else 'off')
+
+        elif cmd == 'ACCUMULATE':
+            action = params[0].upper() if len(params) == 1 else None
+            if len(params) > 1 or action not in (None, 'START', 'STOP', 'RESET'):
+                self.send_text_response('ERROR:102 illegal_arguments')
+                return
+            if action == 'START':
+                accumulator.start()
+            elif action == 'STOP':
+                accumulator.stop()
+            elif action == 'RESET':
+                accumulator.reset()
+            enabled, count = accumulator.status()
+            self.send_response('OK', 'accumulate', 'on' if enabled else 'off', count)
+
+        elif cmd == 'ACCUMULATED':
+            kind = params[0].upper() if len(params) == 1 else 'MEAN'
+            if len(params) > 1 or kind not in ('SUM', 'MEAN', 'VARIANCE'):
+                self.send_text_response('ERROR:102 illegal_arguments')
+                return
+            result = accumulator.result(kind)
+            if result is None:
+                self.send_text_response('ERROR:110 no_accumulated_frames')
+                return
+            count, array = result
+            height, width = array.shape
+            self.send_binary_response('OK accumulated float64 {} {} {} {} {} {}'.format(
+                array.size, width, height, sys.byteorder, kind.lower(), count), array, 'd', array.shape)
+
+        elif cmd == 'CORRECTED_FRAME':
+            frame = context.newest_frame(corrected=False)
+            if frame is None:
+                self.send_text_response('ERROR:105 frame_not_available')
+                return
+            sequence, image = frame
+            image = correction.apply(image)
+            height, width = image.shape
+            self.send_binary_response('OK corrected_frame float32 {} {} {} {} {}'.format(
+                image.size, width, height, sys.byteorder, sequence), image, 'f', image.shape)
+
+    def acquire_wait(self, frames, acq_time, file_type, destfile):
+        """Queue an acquisition and wait until it finishes. Return the error code."""
+
+        job = self.context.scheduler.submit(frames, acq_time, file_type, destfile)
+        job.wait()
+        # the acquisition ran in the scheduler thread; count it as device time of this command.
+        STATS.add_command_device_time(job.device_time)
+        STATS.add_phases(job.phases)
+        return job.errno
+
+    def finish(self):
+        self.context.stream.unsubscribe(self)
+        self.context.state.unlisten(self)
+        BLRequestHandler.finish(self)
+
+
+def handler_class(context):
+    """Return a subclass of TPX3RequestHandler serving the device of `context` by default."""
+
+    return type(str('TPX3RequestHandler{}'.format(context.index)), (TPX3RequestHandler,), {'context': context})
+
 
 # kill the server
 def exitCallback(value):
-    global SERVER
+    global SERVERS
     print("Exit")
-    SERVER.server_close()
+    for server in SERVERS:
+        server.server_close()
 
 # Stop the server when "abort" button is pressed
 def onAbort():
-    global SERVER
+    global SERVERS
 
     def abort_server(server):
         server.shutdown()
         server.server_close()
 
-    Thread(target=abort_server, args=(SERVER,)).start()
+    for server in SERVERS:
+        Thread(target=abort_server, args=(server,)).start()
     print("Aborted")
 
 # main
@@ -190,17 +1514,38 @@ if __name__ == '__main__':
         print("No TPX3 device found. Exit.")
         sys.exit()
 
-    # set the operation mode EVENT+iTOT
-    TPX3 = devices[0]
-    TPX3.setOperationMode(pixet.PX_TPX3_OPM_EVENT_ITOT)
+    for index, device in enumerate(devices):
+        # set the operation mode EVENT+iTOT
+        device.setOperationMode(pixet.PX_TPX3_OPM_EVENT_ITOT)
+        DEVICES.append(DeviceContext(device, index))
     del devices
 
-    # initialize a server.
-    SERVER = socketserver.ThreadingTCPServer(('', PORT), TPX3RequestHandler)
+    if METRICS_PORT is not None:
+        start_metrics_server(METRICS_PORT)
+    if TRACE_FILE is not None:
+        STATS.traces.open_file(TRACE_FILE)
+    TPX3RequestHandler.trace_dir = TRACE_DIR
+
+    # initialize a server per device, listening on PORT, PORT + 1, ...
+    SERVERS = []
+    for context in DEVICES:
+        if USE_ASYNCIO:
+            from bl_async_server import AsyncBLServer
+            SERVERS.append(AsyncBLServer(('', PORT + context.index), handler_class(context),
+                                         max_workers=ASYNC_MAX_WORKERS))
+        else:
+            SERVERS.append(socketserver.ThreadingTCPServer(('', PORT + context.index), handler_class(context)))
     pixet.registerEvent("Exit", exitCallback, exitCallback)
 
-    # run the server.
-    SERVER.serve_forever()
+    # run the servers; the first one in this thread.
+    for server in SERVERS[1:]:
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    SERVERS[0].serve_forever()
 
-    # close the server after the service is stopped (by server.shutdown() from another thread, for example).
-    SERVER.server_close()
+    # close the servers after the service is stopped (by server.shutdown() from another thread, for example).
+    for server in SERVERS[1:]:
+        server.shutdown()
+    for server in SERVERS:
+        server.server_close()